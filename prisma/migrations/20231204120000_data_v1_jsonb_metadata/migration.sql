@@ -0,0 +1,14 @@
+-- AlterTable
+ALTER TABLE "data_v1" ALTER COLUMN "metadata_" SET DATA TYPE JSONB USING "metadata_"::jsonb;
+
+-- CreateIndex
+-- doc_filter in rag_utils Database.get_top_k
+CREATE INDEX "data_v1_metadata_id_idx" ON "data_v1" (("metadata_" ->> 'id'));
+
+-- CreateIndex
+-- per-document deletes in the sync scripts
+CREATE INDEX "data_v1_metadata_doc_id_idx" ON "data_v1" (("metadata_" ->> 'doc_id'));
+
+-- CreateIndex
+-- containment (@>) queries on any metadata key
+CREATE INDEX "data_v1_metadata_idx" ON "data_v1" USING GIN ("metadata_" jsonb_path_ops);
@@ -0,0 +1,6 @@
+-- AlterTable
+-- generated column, so it stays in sync with every insert (Database.add_nodes, the sync scripts' vector_store.add) without any client changes
+ALTER TABLE "data_v1" ADD COLUMN "text_search_tsv" TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', "text")) STORED;
+
+-- CreateIndex
+CREATE INDEX "data_v1_text_search_tsv_idx" ON "data_v1" USING GIN ("text_search_tsv");
@@ -0,0 +1,27 @@
+-- CreateFunction
+-- normalizes the permissions the sync scripts store in chunk metadata into one principal list:
+--   permissions_user  -> 'user:<email or confluence account id>'
+--   permissions_group -> 'group:<email or confluence group name>'
+--   permissions_misc  -> 'public' for drive "anyone" links, 'domain' for domain wide sharing
+-- chunks without any restrictions get 'public', entries that can't be parsed grant nothing.
+-- must stay in sync with rag_utils/AccessScope.py
+CREATE FUNCTION "chunk_acl"("metadata" JSONB) RETURNS TEXT[] LANGUAGE SQL IMMUTABLE PARALLEL SAFE AS $$
+    SELECT CASE WHEN count(*) = 0 THEN ARRAY['public']
+        ELSE coalesce(array_agg(DISTINCT principals.principal) FILTER (WHERE principals.principal IS NOT NULL), '{}') END
+    FROM (
+        SELECT 'user:' || lower(coalesce(nullif(u ->> 'email', ''), u ->> 'accountId', u #>> '{}')) AS principal
+        FROM jsonb_array_elements(CASE WHEN jsonb_typeof("metadata" -> 'permissions_user') = 'array' THEN "metadata" -> 'permissions_user' ELSE '[]'::jsonb END) AS u
+        UNION ALL
+        SELECT 'group:' || lower(coalesce(g ->> 'name', g #>> '{}'))
+        FROM jsonb_array_elements(CASE WHEN jsonb_typeof("metadata" -> 'permissions_group') = 'array' THEN "metadata" -> 'permissions_group' ELSE '[]'::jsonb END) AS g
+        UNION ALL
+        SELECT CASE "metadata" ->> 'permissions_misc' WHEN 'anyone' THEN 'public' ELSE 'domain' END
+        WHERE "metadata" ->> 'permissions_misc' IN ('anyone', 'domain')
+    ) AS principals
+$$;
+
+-- AlterTable
+ALTER TABLE "data_v1" ADD COLUMN "acl" TEXT[] GENERATED ALWAYS AS ("chunk_acl"("metadata_")) STORED;
+
+-- CreateIndex
+CREATE INDEX "data_v1_acl_idx" ON "data_v1" USING GIN ("acl");
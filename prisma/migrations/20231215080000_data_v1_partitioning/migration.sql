@@ -0,0 +1,120 @@
+-- data_v1 is partitioned by tenant (metadata_ ->> 'user_id'), and every tenant partition by source (metadata_ ->> 'source').
+-- every partitioned level has a "<name>_default" partition for rows without a matching partition (e.g. uploads without a user_id).
+-- partition keys are expressions on metadata_, so inserts through llama_index's PGVectorStore are routed without client changes,
+-- but that rules out a primary key (it would have to include the partition key), so id is only indexed.
+
+-- CreateFunction
+-- creates one partition of p_parent for rows whose metadata_ ->> p_key is p_value, optionally partitioned again by p_subpartition_key
+CREATE FUNCTION "create_chunk_partition"(p_parent TEXT, p_partition TEXT, p_key TEXT, p_value TEXT, p_subpartition_key TEXT) RETURNS VOID LANGUAGE plpgsql AS $$
+BEGIN
+    -- rows written before the partition existed sit in the default partition, which would fail the new partition's constraint
+    EXECUTE format('CREATE TEMP TABLE chunk_partition_rows ON COMMIT DROP AS SELECT id, text, metadata_, node_id, embedding FROM %I WHERE metadata_ ->> %L = %L',
+                   p_parent || '_default', p_key, p_value);
+    EXECUTE format('DELETE FROM %I WHERE metadata_ ->> %L = %L', p_parent || '_default', p_key, p_value);
+
+    IF p_subpartition_key IS NULL THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%L)', p_partition, p_parent, p_value);
+    ELSE
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES IN (%L) PARTITION BY LIST ((metadata_ ->> %L))',
+                       p_partition, p_parent, p_value, p_subpartition_key);
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', p_partition || '_default', p_partition);
+    END IF;
+
+    EXECUTE format('INSERT INTO %I (id, text, metadata_, node_id, embedding) SELECT id, text, metadata_, node_id, embedding FROM chunk_partition_rows',
+                   p_parent);
+    DROP TABLE chunk_partition_rows;
+END
+$$;
+
+-- CreateFunction
+-- makes sure the partitions of a tenant (and source) exist and returns the name of the partition its rows are stored in.
+-- called by util/chunks.py before the sync scripts write, and by rag_utils Database.add_nodes.
+-- indexes of the parent (including the vector indexes, see rag_utils/VectorIndex.py) are created on every new partition
+CREATE FUNCTION "ensure_chunk_partition"(p_parent TEXT, p_user_id TEXT, p_source TEXT DEFAULT NULL) RETURNS TEXT LANGUAGE plpgsql AS $$
+DECLARE
+    tenant_partition TEXT := p_parent || '_' || left(md5(p_user_id), 16);
+    source_partition TEXT := tenant_partition || '_' || left(regexp_replace(lower(p_source), '[^a-z0-9]+', '_', 'g'), 20);
+BEGIN
+    IF p_user_id IS NULL THEN
+        RETURN p_parent || '_default';
+    END IF;
+
+    -- only lock while partitions are missing, so writes to existing tenants don't serialize
+    IF to_regclass(tenant_partition) IS NULL OR (p_source IS NOT NULL AND to_regclass(source_partition) IS NULL) THEN
+        -- concurrent syncs of the same tenant would race to create the same partitions
+        PERFORM pg_advisory_xact_lock(hashtext(p_parent || '_partitions'));
+        IF to_regclass(tenant_partition) IS NULL THEN
+            PERFORM "create_chunk_partition"(p_parent, tenant_partition, 'user_id', p_user_id, 'source');
+        END IF;
+        IF p_source IS NOT NULL AND to_regclass(source_partition) IS NULL THEN
+            PERFORM "create_chunk_partition"(tenant_partition, source_partition, 'source', p_source, NULL);
+        END IF;
+    END IF;
+
+    RETURN CASE WHEN p_source IS NULL THEN tenant_partition || '_default' ELSE source_partition END;
+END
+$$;
+
+-- AlterTable
+ALTER TABLE "data_v1" RENAME TO "data_v1_unpartitioned";
+-- keep the id sequence when the old table is dropped
+ALTER SEQUENCE "data_v1_id_seq" OWNED BY NONE;
+
+-- CreateTable
+CREATE TABLE "data_v1" (
+    "id" BIGINT NOT NULL DEFAULT nextval('data_v1_id_seq'),
+    "text" VARCHAR NOT NULL,
+    "metadata_" JSONB,
+    "node_id" VARCHAR,
+    "embedding" VECTOR(1536),
+    "text_search_tsv" TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', "text")) STORED,
+    "acl" TEXT[] GENERATED ALWAYS AS ("chunk_acl"("metadata_")) STORED
+) PARTITION BY LIST (("metadata_" ->> 'user_id'));
+
+ALTER SEQUENCE "data_v1_id_seq" OWNED BY "data_v1"."id";
+
+-- CreateTable
+CREATE TABLE "data_v1_default" PARTITION OF "data_v1" DEFAULT;
+
+-- chunks written before this migration have no user_id or source. The ones of uploaded documents (db/db_utils.py, "docId")
+-- get them from their documents row. The sync scripts' chunks have no record of their user and stay in data_v1_default,
+-- where scoped searches don't see them: A FULL RE-SYNC OF EVERY ACCOUNT IS REQUIRED after this migration. The re-sync
+-- rewrites them with user_id and source, and deletes the legacy rows (see util/chunks.py delete_document_chunks)
+UPDATE "data_v1_unpartitioned" AS "chunk"
+SET "metadata_" = "chunk"."metadata_" || jsonb_build_object('user_id', "documents"."user_id", 'source', "documents"."file_type")
+FROM "documents"
+WHERE "chunk"."metadata_" ->> 'user_id' IS NULL AND "documents"."id" = "chunk"."metadata_" ->> 'docId';
+
+-- one partition per tenant and source that already has chunks
+SELECT "ensure_chunk_partition"('data_v1', "tenants"."user_id", "tenants"."source")
+FROM (
+    SELECT DISTINCT "metadata_" ->> 'user_id' AS "user_id", "metadata_" ->> 'source' AS "source"
+    FROM "data_v1_unpartitioned"
+    WHERE "metadata_" ->> 'user_id' IS NOT NULL
+) AS "tenants";
+
+INSERT INTO "data_v1" ("id", "text", "metadata_", "node_id", "embedding")
+SELECT "id", "text", "metadata_", "node_id", "embedding" FROM "data_v1_unpartitioned";
+
+-- DropTable
+DROP TABLE "data_v1_unpartitioned";
+
+-- CreateIndex
+-- indexes on the parent are created on (and attached from) every partition, now and when ensure_chunk_partition adds one.
+-- the vector indexes are managed by rag_utils/VectorIndex.py
+CREATE INDEX "data_v1_id_idx" ON "data_v1" ("id");
+
+-- CreateIndex
+CREATE INDEX "data_v1_metadata_id_idx" ON "data_v1" (("metadata_" ->> 'id'));
+
+-- CreateIndex
+CREATE INDEX "data_v1_metadata_doc_id_idx" ON "data_v1" (("metadata_" ->> 'doc_id'));
+
+-- CreateIndex
+CREATE INDEX "data_v1_metadata_idx" ON "data_v1" USING GIN ("metadata_" jsonb_path_ops);
+
+-- CreateIndex
+CREATE INDEX "data_v1_text_search_tsv_idx" ON "data_v1" USING GIN ("text_search_tsv");
+
+-- CreateIndex
+CREATE INDEX "data_v1_acl_idx" ON "data_v1" USING GIN ("acl");
@@ -0,0 +1,17 @@
+-- CreateTable
+-- embeddings by model and sha256 of the embedded text, shared by every server process (see rag_utils/EmbeddingCache.py
+-- for queries and util/embeddings.py for chunks).
+-- the sync scripts no longer embed last_modified and last_author_name along with the chunks. The first re-sync after
+-- this migration embeds every chunk again, and until it has run for an account its stored vectors mix both formats
+CREATE TABLE "embedding_cache" (
+    "model" TEXT NOT NULL,
+    "content_hash" TEXT NOT NULL,
+    "embedding" VECTOR NOT NULL,
+    "created_at" TIMESTAMPTZ(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "embedding_cache_pkey" PRIMARY KEY ("model", "content_hash")
+);
+
+-- CreateIndex
+-- pruning of old entries
+CREATE INDEX "embedding_cache_created_at_idx" ON "embedding_cache" ("created_at");
@@ -0,0 +1,72 @@
+-- CreateTable
+-- answers by the embedding of the query they answered, see rag_utils/AnswerCache.py and util/answer_cache.py
+CREATE TABLE "answer_cache" (
+    "id" BIGSERIAL NOT NULL,
+    "user_id" TEXT NOT NULL,
+    -- which engine answered, answers of different prompts aren't interchangeable
+    "namespace" TEXT NOT NULL,
+    -- AccessScope.key() of the search the answer was built from, '' for unscoped searches
+    "scope_key" TEXT NOT NULL,
+    "query" TEXT NOT NULL,
+    "embedding" VECTOR NOT NULL,
+    "answer" TEXT NOT NULL,
+    "sources" JSONB NOT NULL,
+    -- ids of the cited documents (metadata_ ->> 'doc_id' of the chunks), rewriting one of them invalidates the answer
+    "doc_ids" TEXT[] NOT NULL,
+    "created_at" TIMESTAMPTZ(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "last_hit_at" TIMESTAMPTZ(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "hit_count" INTEGER NOT NULL DEFAULT 0,
+
+    CONSTRAINT "answer_cache_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE INDEX "answer_cache_user_id_namespace_scope_key_idx" ON "answer_cache" ("user_id", "namespace", "scope_key");
+
+-- CreateIndex
+-- LRU eviction per tenant
+CREATE INDEX "answer_cache_user_id_last_hit_at_idx" ON "answer_cache" ("user_id", "last_hit_at");
+
+-- CreateIndex
+-- invalidation by the sync scripts
+CREATE INDEX "answer_cache_doc_ids_idx" ON "answer_cache" USING GIN ("doc_ids");
+
+-- CreateFunction
+-- the closest live answer of the tenant, namespace and scope if it is at least p_min_similarity (cosine) close. marks it as used
+CREATE FUNCTION "answer_cache_lookup"(p_user_id TEXT, p_namespace TEXT, p_scope_key TEXT, p_embedding VECTOR,
+                                      p_min_similarity DOUBLE PRECISION, p_ttl INTERVAL)
+RETURNS TABLE ("id" BIGINT, "query" TEXT, "answer" TEXT, "sources" JSONB, "similarity" DOUBLE PRECISION) LANGUAGE SQL AS $$
+    WITH nearest AS (
+        SELECT c.id, c.query, c.answer, c.sources, 1 - (c.embedding <=> p_embedding) AS similarity
+        FROM answer_cache c
+        WHERE c.user_id = p_user_id AND c.namespace = p_namespace AND c.scope_key = p_scope_key
+            AND c.created_at > now() - p_ttl
+        ORDER BY c.embedding <=> p_embedding
+        LIMIT 1
+    ), hit AS (
+        UPDATE answer_cache c SET last_hit_at = now(), hit_count = c.hit_count + 1
+        FROM nearest
+        WHERE c.id = nearest.id AND nearest.similarity >= p_min_similarity
+        RETURNING c.id
+    )
+    SELECT nearest.id, nearest.query, nearest.answer, nearest.sources, nearest.similarity
+    FROM nearest JOIN hit ON hit.id = nearest.id
+$$;
+
+-- CreateFunction
+-- stores an answer, after evicting the tenant's expired answers and its least recently used ones beyond p_max_entries
+CREATE FUNCTION "answer_cache_store"(p_user_id TEXT, p_namespace TEXT, p_scope_key TEXT, p_query TEXT, p_embedding VECTOR,
+                                     p_answer TEXT, p_sources JSONB, p_doc_ids TEXT[], p_ttl INTERVAL, p_max_entries INTEGER)
+RETURNS BIGINT LANGUAGE SQL AS $$
+    DELETE FROM answer_cache c
+    WHERE c.user_id = p_user_id AND (c.created_at <= now() - p_ttl OR c.id IN (
+        SELECT e.id FROM answer_cache e
+        WHERE e.user_id = p_user_id
+        ORDER BY e.last_hit_at DESC
+        OFFSET greatest(p_max_entries - 1, 0)
+    ));
+
+    INSERT INTO answer_cache (user_id, namespace, scope_key, query, embedding, answer, sources, doc_ids)
+    VALUES (p_user_id, p_namespace, p_scope_key, p_query, p_embedding, p_answer, p_sources, p_doc_ids)
+    RETURNING id;
+$$;
@@ -4,7 +4,7 @@ import os
 from pprint import pprint
 # from llama_index.text_splitter import SentenceSplitter
 from llama_index.node_parser import SimpleNodeParser
-from llama_index.schema import NodeRelationship, MetadataMode
+from llama_index.schema import NodeRelationship
 
 from llama_index import Document
 from datetime import datetime
@@ -13,6 +13,10 @@ from llama_index.embeddings import OpenAIEmbedding
 from llama_index import ServiceContext, set_global_service_context
 from llama_index.llms import OpenAI
 
+from util.answer_cache import invalidate_answers
+from util.chunks import ensure_chunk_partition, notify_chunks_changed
+from util.embeddings import embed_nodes
+
 embed_model = OpenAIEmbedding(embed_batch_size=10)
 vector_store = PGVectorStore.from_params(
     database=os.environ.get("DB_DATABASE"),
@@ -99,26 +103,32 @@ async def add_sync_document_db(data: dict, userId: str):
 
         # delete all previous nodes
         vector_store.delete(doc.refDocId)
+        await invalidate_answers([doc.refDocId])
 
     # add new documentChunks
     doc = Document(text=data['contents'], id=data['id'], excluded_embed_metadata_keys=[
-                   "docId", "src", "file_type"], excluded_llm_metadata_keys=["docId", "src", "file_type"])
+                   "docId", "src", "file_type", "user_id", "source"], excluded_llm_metadata_keys=["docId", "src", "file_type", "user_id", "source"])
     nodes = node_parser.get_nodes_from_documents([doc])
+    # the file type is the integration the document was synced from, e.g. "slack"
+    source = data.get('fileType', 'defaultType')
 
     for node in nodes:
         # add metadata
         node.metadata['title'] = data.get("fileName", "Default Name")
         node.metadata['docId'] = data['id']
         node.metadata['src'] = data['src']
-        node.metadata['file_type'] = data.get('fileType', 'defaultType')
+        node.metadata['file_type'] = source
+        # routes the chunks to the tenant and source partition, and scopes them to the user's searches
+        node.metadata['user_id'] = userId
+        node.metadata['source'] = source
 
-        node_embedding = embed_model.get_text_embedding(
-            node.get_content(metadata_mode=MetadataMode.EMBED)
-        )
-        node.embedding = node_embedding
+    # unchanged chunks of a re-synced document reuse their stored embeddings
+    await embed_nodes(nodes, embed_model)
 
     if nodes:
+        await ensure_chunk_partition(userId, source)
         vector_store.add(nodes)
+        await notify_chunks_changed(userId, [data['id']])
         relationship_info = nodes[0].relationships[NodeRelationship.SOURCE]
         ref_node_id = relationship_info.node_id
 
@@ -0,0 +1,48 @@
+from typing import List, Optional
+
+# principal of chunks without any user/group restrictions (Notion pages, unrestricted Confluence pages, "anyone" Drive files)
+PUBLIC_PRINCIPAL = "public"
+# principal of Drive files shared with the whole domain
+DOMAIN_PRINCIPAL = "domain"
+
+
+class AccessScope():
+    '''
+    Who a search is run for. Searches only the user's own partition of the chunk tables (see the data_v1_partitioning migration),
+    and only the chunks whose acl column has one of the scope's principals (see the data_v1_acl migration)
+    '''
+    user_id: str
+    identities: List[str]
+    groups: List[str]
+    domain_access: bool
+
+    def __init__(self, user_id: str, identities: List[str], groups: Optional[List[str]] = None, domain_access: bool = True):
+        # identities are whatever the sources restrict by: emails for Drive, emails or account ids for Confluence
+        self.user_id = user_id
+        self.identities = identities
+        self.groups = groups if groups is not None else []
+        self.domain_access = domain_access
+
+    def principals(self) -> List[str]:
+        '''
+        The acl entries this scope may read, in the same normalized form as the acl column
+        '''
+        principals = [PUBLIC_PRINCIPAL]
+        if self.domain_access:
+            principals.append(DOMAIN_PRINCIPAL)
+        principals += ["user:" + identity.lower()
+                       for identity in self.identities]
+        principals += ["group:" + group.lower() for group in self.groups]
+        return principals
+
+    def key(self) -> str:
+        '''
+        Stable identifier of the scope, two scopes with the same key can read exactly the same chunks
+        '''
+        return self.user_id + "|" + ",".join(sorted(set(self.principals())))
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"AccessScope(user_id={self.user_id}, principals={self.principals()})"
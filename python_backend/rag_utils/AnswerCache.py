@@ -0,0 +1,86 @@
+from typing import List, Optional
+
+from AccessScope import AccessScope
+from Database import Database
+from Node import Node
+from Query import Query
+
+QA_ENGINE_NAMESPACE = "qa_engine"
+# ada-002 similarities are compressed into ~0.7-1.0, rephrasings of the same question land above this
+DEFAULT_MIN_SIMILARITY = 0.97
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class CachedAnswer():
+    query: str
+    answer: str
+    sources: List[Node]
+    similarity: float
+
+    def __init__(self, query: str, answer: str, sources: List[Node], similarity: float):
+        self.query = query
+        self.answer = answer
+        self.sources = sources
+        self.similarity = similarity
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"CachedAnswer(query={self.query}, answer={self.answer}, similarity={self.similarity})"
+
+
+class AnswerCache():
+    '''
+    Semantic cache of answers, shared by every server process through the answer_cache table.
+    A query is answered from the cache when a cached query of the same tenant and access scope is within min_similarity of it.
+    Answers expire after ttl_seconds, every tenant keeps its max_entries most recently used ones, and the sync scripts
+    drop the answers citing a document when they rewrite it (see util/chunks.py)
+    '''
+    db: Database
+    namespace: str
+    min_similarity: float
+    ttl_seconds: int
+    max_entries: int
+
+    def __init__(self,
+                 db: Database,
+                 namespace: str = QA_ENGINE_NAMESPACE,
+                 min_similarity: float = DEFAULT_MIN_SIMILARITY,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.db = db
+        self.namespace = namespace
+        self.min_similarity = min_similarity
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+    async def lookup(self, scope: AccessScope, query: Query) -> Optional[CachedAnswer]:
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow("SELECT query, answer, sources, similarity FROM answer_cache_lookup($1, $2, $3, $4, $5, make_interval(secs => $6))",
+                                      scope.user_id, self.namespace, scope.key(), query.embedding, self.min_similarity, self.ttl_seconds)
+        if row is None:
+            return None
+
+        sources = [Node(node_id=source['node_id'], text=source['text'], metadata=source['metadata'])
+                   for source in row['sources']]
+        return CachedAnswer(query=row['query'], answer=row['answer'], sources=sources, similarity=row['similarity'])
+
+    async def store(self, scope: AccessScope, query: Query, answer: str, sources: List[Node]):
+        # subqueries often cite the same chunks
+        sources = list({source.node_id: source for source in sources}.values())
+        sources_json = [{"node_id": source.node_id, "text": source.text, "metadata": source.metadata}
+                        for source in sources]
+        doc_ids = list(set([source.metadata['doc_id'] for source in sources
+                            if source.metadata.get('doc_id') is not None]))
+        async with self.db.acquire() as conn:
+            await conn.execute("SELECT answer_cache_store($1, $2, $3, $4, $5, $6, $7, $8, make_interval(secs => $9), $10)",
+                               scope.user_id, self.namespace, scope.key(), query.q, query.embedding,
+                               answer, sources_json, doc_ids, self.ttl_seconds, self.max_entries)
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"AnswerCache(namespace={self.namespace}, min_similarity={self.min_similarity}, ttl_seconds={self.ttl_seconds}, max_entries={self.max_entries})"
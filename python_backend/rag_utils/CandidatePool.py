@@ -0,0 +1,56 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from Node import Node, ScoredNode
+from Query import Query
+
+# rephrasings of the same subquery ("revenue growth of Uber", "Uber revenue growth") land above this with ada-002
+DEFAULT_DUPLICATE_SIMILARITY = 0.97
+
+
+class CandidatePool():
+    '''
+    The subqueries and retrieved chunks of one question. Subqueries nearly identical to an earlier one are collapsed into it,
+    and a chunk retrieved by several subqueries is a single node, sent once by prompts covering several subqueries
+    '''
+    duplicate_similarity: float
+    subqueries: List[Query]
+    nodes: Dict[str, Node]
+
+    def __init__(self, duplicate_similarity: float = DEFAULT_DUPLICATE_SIMILARITY):
+        self.duplicate_similarity = duplicate_similarity
+        self.subqueries = []
+        self.nodes = {}
+        # normalized embeddings of the subqueries, one row each
+        self._embeddings = None
+
+    def add_subquery(self, subquery: Query) -> Optional[Query]:
+        '''
+        Adds the subquery and returns None, or returns the subquery of the pool it duplicates without adding it
+        '''
+        embedding = np.asarray(subquery.embedding, dtype=np.float32)
+        embedding = embedding / max(np.linalg.norm(embedding), 1e-12)
+        if self._embeddings is not None:
+            similarities = self._embeddings @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.duplicate_similarity:
+                return self.subqueries[best]
+
+        self.subqueries.append(subquery)
+        self._embeddings = embedding[np.newaxis] if self._embeddings is None else \
+            np.vstack([self._embeddings, embedding])
+        return None
+
+    def add_candidates(self, candidates: List[ScoredNode]) -> List[ScoredNode]:
+        '''
+        The candidates, with the chunks already in the pool replaced by the pooled node
+        '''
+        return [ScoredNode(node=self.nodes.setdefault(candidate.node.node_id, candidate.node), score=candidate.score)
+                for candidate in candidates]
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"CandidatePool(subqueries={len(self.subqueries)}, nodes={len(self.nodes)})"
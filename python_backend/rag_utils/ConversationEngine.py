@@ -1,8 +1,13 @@
-from typing import List
+from typing import AsyncGenerator, List, Union
 
+from AccessScope import AccessScope
+from AnswerCache import AnswerCache
 from Database import Database
 from DataEmitter import DataEmitter
+from EmbeddingCache import EmbeddingCache
+from MemoryMappedDatabase import MemoryMappedDatabase
 from Message import Message, UserMessage, AIMessage
+from PromptPacker import by_rank, get_prompt_packer
 from QAEngine import QAEngine
 from Query import Query
 from Reranker import Reranker
@@ -15,6 +20,17 @@ NEWLINE = "\n==\n"
 
 
 def generate_context_request_prompt(new_message: UserMessage, last_message: AIMessage):
+    sources = by_rank([sq.sources or [] for sq in last_message.subqueries], key=lambda source: source.id)
+    source_strs = [s.to_content_str() for s in sources]
+    # the most relevant cited sources that fit the conversation model's budget
+    kept_sources, _ = get_prompt_packer(DEFAULT_CONVERSATION_MODEL).pack(
+        prompt="context_request", fixed=render_context_request_prompt(new_message=new_message, last_message=last_message, sources_str=""),
+        sources=source_strs, separator=NEWLINE)
+    return render_context_request_prompt(new_message=new_message, last_message=last_message,
+                                         sources_str=NEWLINE.join([source_strs[i] for i in kept_sources]))
+
+
+def render_context_request_prompt(new_message: UserMessage, last_message: AIMessage, sources_str: str):
     return f"""\
 You are an agent designed to answer questions given chunks of texts from documents. We are to determine the next steps given a new query.
 
@@ -25,7 +41,7 @@ Previous queries:
 {NEWLINE.join([sq.subquery for sq in last_message.subqueries])}
 
 Sources cited
-{NEWLINE.join([s.to_content_str() for sq in last_message.subqueries for s in sq.sources])}
+{sources_str}
 
 …
 
@@ -45,18 +61,39 @@ class ConversationEngine():
     reranker: Reranker
     subquery_engine: SubQueryEngine
     qa_engine: QAEngine
+    embedding_cache: EmbeddingCache
 
-    def __init__(self, db: Database, reranker: Reranker, subquery_engine: SubQueryEngine):
+    def __init__(self, db: Database, reranker: Reranker, subquery_engine: SubQueryEngine, answer_cache: AnswerCache = None):
         self.db = db
         self.reranker = reranker
         self.subquery_engine = subquery_engine
-        self.qa_engine = QAEngine(db, reranker, subquery_engine)
-
-    async def generate_response(self, message: UserMessage, history: List[Message], data_emitter: DataEmitter):
-        query = Query(message.message)
+        self.embedding_cache = EmbeddingCache(db)
+        self.qa_engine = QAEngine(
+            db, reranker, subquery_engine, embedding_cache=self.embedding_cache, answer_cache=answer_cache)
+
+    async def listen(self):
+        '''
+        Keeps the in-process caches, and the snapshot of a MemoryMappedDatabase, in step with the syncs' rewrites of documents
+        (see util/chunks.py notify_chunks_changed).
+        Call once after building the engine, on the event loop that serves it
+        '''
+        db = self.db
+        if isinstance(db, MemoryMappedDatabase):
+            await db.listen()
+            # notifications come in on the database the snapshot is refreshed from
+            db = db.db
+        if self.reranker.cache is not None:
+            await self.reranker.cache.listen(db)
+
+    async def generate_response(self, message: UserMessage, history: List[Message], data_emitter: DataEmitter, scope: AccessScope = None,
+                                use_stream: bool = False) -> Union[str, AsyncGenerator[str, None]]:
+        '''
+        The response to the message, or with use_stream an async generator of its tokens
+        '''
+        query = await Query.create(message.message, embedding_cache=self.embedding_cache)
         # if first message in conversation
         if len(history) == 0:
-            res = await self.qa_engine.answer(query=query, use_subqueries=True, data_emitter=data_emitter)
+            res = await self.qa_engine.answer(query=query, use_subqueries=True, data_emitter=data_emitter, scope=scope, use_stream=use_stream)
         else:
             # Determine if new context is needed
             context_determination_prompt = generate_context_request_prompt(
@@ -66,13 +103,13 @@ class ConversationEngine():
             data_emitter.emit("context_determination_result: ", llm_response)
 
             if llm_response == "Start new query":
-                res = await self.qa_engine.answer(query=query, use_subqueries=True, data_emitter=data_emitter, message_history=history)
+                res = await self.qa_engine.answer(query=query, use_subqueries=True, data_emitter=data_emitter, message_history=history, scope=scope, use_stream=use_stream)
             elif llm_response == "Search documents":
                 doc_list = list(
                     set([s.id for sq in history[-1].subqueries for s in sq.sources]))
-                res = await self.qa_engine.answer(query=query, use_subqueries=True, data_emitter=data_emitter, message_history=history, doc_filter=doc_list)
+                res = await self.qa_engine.answer(query=query, use_subqueries=True, data_emitter=data_emitter, message_history=history, doc_filter=doc_list, scope=scope, use_stream=use_stream)
             elif llm_response == "Use same sources":
-                res = await self.qa_engine.answer(query=query, use_subqueries=False, data_emitter=data_emitter, message_history=history, use_last_message_sources=True)
+                res = await self.qa_engine.answer(query=query, use_subqueries=False, data_emitter=data_emitter, message_history=history, use_last_message_sources=True, scope=scope, use_stream=use_stream)
             else:
                 print("RESPONSE: " + llm_response)
                 raise Exception("Invalid response from LLM")
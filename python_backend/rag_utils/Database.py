@@ -1,57 +1,386 @@
+import asyncio
+import json
 import os
-from typing import List
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, List, Optional, Union
 
-import psycopg2
-from psycopg2.extras import execute_values
-from pgvector.psycopg2 import register_vector
+import asyncpg
+from pgvector.asyncpg import register_vector
 
-from Node import Node, ScoredNode
+from AccessScope import AccessScope
+from Node import Node, ScoredNode, json_loads
 from Query import Query
 
+DEFAULT_MIN_POOL_SIZE = 2
+DEFAULT_MAX_POOL_SIZE = 10
+# seconds to wait for a free pooled connection before giving up
+DEFAULT_ACQUIRE_TIMEOUT = 10.0
+# temp table add_nodes copies into before merging, dropped when the load commits
+STAGING_TABLE = "staging_nodes"
+# the sync scripts notify on this channel after rewriting chunks (see util/chunks.py)
+CHUNKS_CHANGED_CHANNEL = "chunks_changed"
+
+# recall level -> ANN index search parameters applied for a single search.
+# pgvector's own defaults (hnsw.ef_search = 40, ivfflat.probes = 1) apply when no recall level is given
+RECALL_SEARCH_PARAMS = {
+    "low": {"hnsw.ef_search": "20", "ivfflat.probes": "1"},
+    "medium": {"hnsw.ef_search": "40", "ivfflat.probes": "5"},
+    "high": {"hnsw.ef_search": "100", "ivfflat.probes": "20"},
+    # skips the ANN index entirely and does an exact scan
+    "exact": {"enable_indexscan": "off"},
+}
+
+VECTOR_SEARCH_MODE = "vector"
+HYBRID_SEARCH_MODE = "hybrid"
+SEARCH_MODES = [VECTOR_SEARCH_MODE, HYBRID_SEARCH_MODE]
+# must match the config of the generated text_search_tsv column
+TEXT_SEARCH_CONFIG = "english"
+# each ranking contributes this many times k candidates to the fusion
+HYBRID_CANDIDATE_MULTIPLIER = 4
+# standard reciprocal rank fusion constant, dampens the weight of the very top ranks
+RRF_K = 60
+
+FULL_PRECISION = "full"
+HALF_PRECISION = "half"
+BINARY_PRECISION = "binary"
+PRECISIONS = [FULL_PRECISION, HALF_PRECISION, BINARY_PRECISION]
+# halfvec/bit casts need a fixed dimension, this is the size of the ada-002 embeddings
+EMBEDDING_DIMENSIONS = 1536
+# compact searches fetch this many times k candidates, then re-score them against the full precision vectors
+DEFAULT_RESCORE_OVERSAMPLE = {
+    HALF_PRECISION: 2,
+    BINARY_PRECISION: 10,
+}
+DISTANCE_OPERATORS = {
+    FULL_PRECISION: "<=>",  # cosine
+    HALF_PRECISION: "<=>",  # cosine
+    BINARY_PRECISION: "<~>",  # hamming
+}
+
+
+def _add_param(params: List[Any], value: Any) -> str:
+    '''
+    Appends a query parameter and returns its placeholder
+    '''
+    params.append(value)
+    return f"${len(params)}"
+
+
+def _where(conditions: List[str]) -> str:
+    if len(conditions) == 0:
+        return ""
+    return " WHERE " + " AND ".join(conditions)
+
+
+def compact_embedding_sql(embedding: str, precision: str) -> str:
+    '''
+    SQL expression for the compact copy of an embedding. Expression indexes (see VectorIndexManager) are built on exactly
+    this expression over the embedding column, so the index holds the only stored copy of the compact vectors
+    '''
+    if precision == HALF_PRECISION:
+        return "(" + embedding + ")::halfvec(" + str(EMBEDDING_DIMENSIONS) + ")"
+    if precision == BINARY_PRECISION:
+        return "binary_quantize(" + embedding + ")::bit(" + str(EMBEDDING_DIMENSIONS) + ")"
+    return embedding
+
+
+def distance_sql(column: str, embedding: str, precision: str) -> str:
+    return compact_embedding_sql(column, precision) + " " + DISTANCE_OPERATORS[precision] + " " + compact_embedding_sql(embedding, precision)
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    '''
+    Runs once for every new connection the pool opens
+    '''
+    # Register the vector type with asyncpg
+    await register_vector(conn)
+    # decode json columns into dicts (psycopg2 used to do this for us).
+    # binary codecs so the columns can also be written with binary COPY (jsonb's binary format is a version byte + text)
+    await conn.set_type_codec('json', encoder=lambda value: json.dumps(value).encode(),
+                              decoder=json_loads, schema='pg_catalog', format='binary')
+    await conn.set_type_codec('jsonb', encoder=lambda value: b'\x01' + json.dumps(value).encode(),
+                              decoder=lambda data: json_loads(data[1:]), schema='pg_catalog', format='binary')
+
 
 class Database():
-    conn: psycopg2.extensions.connection
-    cur: psycopg2.extensions.cursor
+    pool: Optional[asyncpg.Pool]
+    listen_conn: Optional[asyncpg.Connection]
+    connection_string: str
     vector_store_table: str
+    min_pool_size: int
+    max_pool_size: int
+    acquire_timeout: float
+    precision: str
 
-    def __init__(self, vector_store_table: str):
+    def __init__(self,
+                 vector_store_table: str,
+                 min_pool_size: int = DEFAULT_MIN_POOL_SIZE,
+                 max_pool_size: int = DEFAULT_MAX_POOL_SIZE,
+                 acquire_timeout: float = DEFAULT_ACQUIRE_TIMEOUT,
+                 precision: str = FULL_PRECISION):
         connection_string = os.getenv("DATABASE_URL")
         if connection_string is None:
             raise Exception(
                 "No database connection string provided. Please set the DATABASE_URL environment variable.")
 
-        self.conn = psycopg2.connect(connection_string)
-        self.cur = self.conn.cursor()
-        # install pgvector
-        self.cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
-        self.conn.commit()
-
+        self.connection_string = connection_string
         self.vector_store_table = vector_store_table
+        self.min_pool_size = min_pool_size
+        self.max_pool_size = max_pool_size
+        self.acquire_timeout = acquire_timeout
+        # precision the first pass of searches runs at, unless overridden per search
+        self.precision = precision
+
+        # the pool is created lazily, on the event loop that first uses it
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+        # LISTEN needs a connection that stays checked out, so it lives outside the pool
+        self.listen_conn = None
+
+    async def connect(self) -> asyncpg.Pool:
+        if self.pool is not None:
+            return self.pool
+
+        async with self._pool_lock:
+            if self.pool is None:
+                # install pgvector before any pooled connection tries to register the type
+                conn = await asyncpg.connect(self.connection_string)
+                try:
+                    await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+                finally:
+                    await conn.close()
+
+                self.pool = await asyncpg.create_pool(self.connection_string,
+                                                      min_size=self.min_pool_size,
+                                                      max_size=self.max_pool_size,
+                                                      init=_init_connection)
+        return self.pool
+
+    async def kill(self):
+        if self.listen_conn is not None:
+            await self.listen_conn.close()
+            self.listen_conn = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
 
-        # Register the vector type with psycopg2
-        register_vector(self.conn)
+    async def listen(self, channel: str, callback: Callable[[Dict[str, Any]], None]):
+        '''
+        Calls callback with the decoded json payload of every notification sent on the channel
+        '''
+        if self.listen_conn is None:
+            self.listen_conn = await asyncpg.connect(self.connection_string)
+        await self.listen_conn.add_listener(channel, lambda _conn, _pid, _channel, payload: callback(json.loads(payload)))
 
-    def kill(self):
-        self.conn.close()
+    @asynccontextmanager
+    async def acquire(self):
+        '''
+        Borrows a connection from the pool, failing if none frees up within acquire_timeout
+        '''
+        pool = await self.connect()
+        async with pool.acquire(timeout=self.acquire_timeout) as conn:
+            yield conn
 
-    def add_nodes(self, nodes: List[Node]):
-        # insert nodes
-        insert_query = "INSERT INTO " + self.vector_store_table + \
-            " (text, metadata, node_id, embedding) VALUES %s ON CONFLICT DO NOTHING"
-        execute_values(self.cur, insert_query, nodes)
-        self.conn.commit()
+    @asynccontextmanager
+    async def _search_connection(self, recall: Optional[str] = None):
+        '''
+        Borrows a connection with the index search parameters for the requested recall level applied
+        '''
+        if recall is not None and recall not in RECALL_SEARCH_PARAMS:
+            raise ValueError(
+                f"Invalid recall level {recall}, expected one of {list(RECALL_SEARCH_PARAMS.keys())}")
 
-    async def get_top_k(self, query: Query, k: int, doc_filter: List[str] = None) -> List[ScoredNode]:
-        # get top k vectors
-        if doc_filter is None:
-            self.cur.execute("SELECT node_id, text, metadata_, 1 - (embedding <=> %s) AS cosine_similarity FROM " + self.vector_store_table +
-                            " ORDER BY embedding <=> %s LIMIT %s", (query.embedding, query.embedding, k))
-            result = self.cur.fetchall()
-            return [ScoredNode(node=Node(node_id=row[0], text=row[1], metadata=row[2]), score=row[3]) for row in result]
+        async with self.acquire() as conn:
+            if recall is not None:
+                # session level settings are safe here: the pool runs RESET ALL when the connection is released
+                params = RECALL_SEARCH_PARAMS[recall]
+                await conn.execute("SELECT set_config(name, value, false) FROM unnest($1::text[], $2::text[]) AS p(name, value)",
+                                   list(params.keys()), list(params.values()))
+            yield conn
 
-        else:
+    async def add_nodes(self, nodes: Union[Iterable[Node], AsyncIterable[Node]]) -> Dict[str, Any]:
+        '''
+        Bulk loads nodes with a binary COPY into a staging table, then merges them into the vector store table.
+        Nodes are streamed from the (async) iterable, so memory stays flat for large syncs.
+        Returns the number of rows copied and inserted, and the load rate
+        '''
+        row_count = 0
+
+        async def node_records():
+            nonlocal row_count
+            if hasattr(nodes, '__aiter__'):
+                async for node in nodes:
+                    row_count += 1
+                    yield (node.text, node.metadata, node.node_id, node.embedding)
+            else:
+                for node in nodes:
+                    row_count += 1
+                    yield (node.text, node.metadata, node.node_id, node.embedding)
+
+        start = time.perf_counter()
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("CREATE TEMP TABLE " + STAGING_TABLE +
+                                   " (text varchar, metadata_ jsonb, node_id varchar, embedding vector) ON COMMIT DROP")
+                await conn.copy_records_to_table(STAGING_TABLE, records=node_records(),
+                                                 columns=['text', 'metadata_', 'node_id', 'embedding'])
+                # rows are routed by their user_id and source, make sure those partitions exist before merging
+                await conn.execute("SELECT ensure_chunk_partition($1, tenants.user_id, tenants.source) FROM (" +
+                                   "SELECT DISTINCT metadata_ ->> 'user_id' AS user_id, metadata_ ->> 'source' AS source FROM " + STAGING_TABLE +
+                                   " WHERE metadata_ ->> 'user_id' IS NOT NULL) AS tenants", self.vector_store_table)
+                # merge
+                status = await conn.execute("INSERT INTO " + self.vector_store_table + " (text, metadata_, node_id, embedding)" +
+                                            " SELECT text, metadata_, node_id, embedding FROM " + STAGING_TABLE + " ON CONFLICT DO NOTHING")
+        elapsed = time.perf_counter() - start
+
+        # status is "INSERT 0 <rows>"
+        inserted_count = int(status.split()[-1])
+        return {
+            "rows": row_count,
+            "inserted": inserted_count,
+            "seconds": elapsed,
+            "rows_per_sec": row_count / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def _to_scored_node(self, row: asyncpg.Record) -> ScoredNode:
+        return ScoredNode(node=Node(node_id=row['node_id'], text=row['text'], metadata=row['metadata_'], embedding=row.get('embedding')),
+                          score=row['cosine_similarity'])
+
+    def _filter_conditions(self, params: List[Any], doc_filter: List[str] = None, scope: Optional[AccessScope] = None) -> List[str]:
+        conditions = []
+        if scope is not None:
+            # same expression as the partition key, so only the tenant's partitions (and their indexes) are searched
+            conditions.append("chunk.metadata_ ->> 'user_id' = " +
+                              _add_param(params, scope.user_id))
+            # overlap with the GIN indexed acl column, so only chunks the scope can read are ever ranked
+            conditions.append("chunk.acl && " +
+                              _add_param(params, scope.principals()) + "::text[]")
+        if doc_filter is not None:
             # list contains ids of documents to include. the ids match to the "id" field of the column "metadata_" which contains a json object
-            self.cur.execute("SELECT node_id, text, metadata_, 1 - (embedding <=> %s) AS cosine_similarity FROM " + self.vector_store_table +
-                            " WHERE metadata_ ->> 'id' IN %s ORDER BY embedding <=> %s LIMIT %s", (query.embedding, tuple(doc_filter), query.embedding, k))
-            result = self.cur.fetchall()
-            return [ScoredNode(node=Node(node_id=row[0], text=row[1], metadata=row[2]), score=row[3]) for row in result]
\ No newline at end of file
+            conditions.append("chunk.metadata_ ->> 'id' = ANY(" +
+                              _add_param(params, list(doc_filter)) + "::text[])")
+        return conditions
+
+    def _top_k_sql(self, embedding: str, text: str, k: str, conditions: List[str], mode: str, precision: str, oversample: Optional[int],
+                   with_embeddings: bool = False) -> str:
+        '''
+        Builds the SELECT for the top k chunks of one query, given the SQL expressions for the query's embedding, text and k.
+        Rows come back with the cosine similarity and the score they are ranked by (the same thing for vector search)
+        '''
+        if mode not in SEARCH_MODES:
+            raise ValueError(
+                f"Invalid search mode {mode}, expected one of {SEARCH_MODES}")
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Invalid precision {precision}, expected one of {PRECISIONS}")
+
+        order_by = distance_sql("chunk.embedding", embedding, precision)
+        columns = "chunk.node_id, chunk.text, chunk.metadata_" + \
+            (", chunk.embedding" if with_embeddings else "")
+
+        if mode == VECTOR_SEARCH_MODE:
+            if precision == FULL_PRECISION:
+                return "SELECT " + columns + ", 1 - (chunk.embedding <=> " + embedding + ") AS cosine_similarity," + \
+                    " 1 - (chunk.embedding <=> " + embedding + ") AS search_score" + \
+                    " FROM " + self.vector_store_table + " chunk" + _where(conditions) + \
+                    " ORDER BY " + order_by + " LIMIT " + k
+
+            # oversample candidates from the compact index, then re-score them exactly
+            if oversample is None:
+                oversample = DEFAULT_RESCORE_OVERSAMPLE[precision]
+            return "SELECT candidates.*, candidates.cosine_similarity AS search_score FROM (" + \
+                " SELECT " + columns + ", 1 - (chunk.embedding <=> " + embedding + ") AS cosine_similarity" + \
+                " FROM " + self.vector_store_table + " chunk" + _where(conditions) + \
+                " ORDER BY " + order_by + " LIMIT (" + k + ") * " + str(int(oversample)) + ") candidates" + \
+                " ORDER BY candidates.cosine_similarity DESC LIMIT " + k
+
+        # hybrid: rank candidates separately by vector distance and full text relevance, then fuse the two rankings with RRF
+        candidates = "(" + k + ") * " + str(HYBRID_CANDIDATE_MULTIPLIER)
+        text_query = "websearch_to_tsquery('" + TEXT_SEARCH_CONFIG + "', " + text + ")"
+        semantic_sql = "SELECT ranked.id, row_number() OVER (ORDER BY ranked.distance) AS rank FROM (" + \
+            " SELECT chunk.id, " + order_by + " AS distance" + \
+            " FROM " + self.vector_store_table + " chunk" + _where(conditions) + \
+            " ORDER BY " + order_by + " LIMIT " + candidates + ") ranked"
+        lexical_sql = "SELECT ranked.id, row_number() OVER (ORDER BY ranked.text_rank DESC) AS rank FROM (" + \
+            " SELECT chunk.id, ts_rank_cd(chunk.text_search_tsv, " + text_query + ") AS text_rank" + \
+            " FROM " + self.vector_store_table + " chunk" + _where(conditions + ["chunk.text_search_tsv @@ " + text_query]) + \
+            " ORDER BY text_rank DESC LIMIT " + candidates + ") ranked"
+        fused_sql = "SELECT coalesce(semantic.id, lexical.id) AS id," + \
+            " coalesce(1.0 / (" + str(RRF_K) + " + semantic.rank), 0) + coalesce(1.0 / (" + str(RRF_K) + " + lexical.rank), 0) AS rrf_score" + \
+            " FROM (" + semantic_sql + ") semantic FULL OUTER JOIN (" + lexical_sql + ") lexical ON semantic.id = lexical.id"
+
+        return "SELECT " + columns + ", 1 - (chunk.embedding <=> " + embedding + ") AS cosine_similarity," + \
+            " fused.rrf_score AS search_score" + \
+            " FROM (" + fused_sql + ") fused JOIN " + self.vector_store_table + " chunk ON chunk.id = fused.id" + \
+            " ORDER BY fused.rrf_score DESC LIMIT " + k
+
+    async def get_top_k(self,
+                        query: Query,
+                        k: int,
+                        doc_filter: List[str] = None,
+                        scope: Optional[AccessScope] = None,
+                        recall: Optional[str] = None,
+                        mode: str = VECTOR_SEARCH_MODE,
+                        precision: Optional[str] = None,
+                        oversample: Optional[int] = None,
+                        with_embeddings: bool = False) -> List[ScoredNode]:
+        '''
+        Gets the top k chunks for the query. In hybrid mode chunks are ordered by the fused vector + full text ranking,
+        but the returned score is still the cosine similarity.
+        With a half or binary precision the candidates are found on the compact index and re-scored at full precision.
+        With a scope only chunks whose acl overlaps the scope's principals are considered.
+        with_embeddings also returns the chunks' embeddings (node.embedding), e.g. for MMR
+        '''
+        params = []
+        embedding = _add_param(params, query.embedding)
+        text = _add_param(params, query.q) if mode == HYBRID_SEARCH_MODE else None
+        k_param = _add_param(params, k)
+        sql_query = self._top_k_sql(embedding=embedding, text=text, k=k_param,
+                                    conditions=self._filter_conditions(params, doc_filter, scope), mode=mode,
+                                    precision=precision or self.precision, oversample=oversample, with_embeddings=with_embeddings)
+
+        async with self._search_connection(recall=recall) as conn:
+            result = await conn.fetch(sql_query, *params)
+
+        return [self._to_scored_node(row) for row in result]
+
+    async def get_top_k_many(self,
+                             queries: List[Query],
+                             k: int,
+                             doc_filter: List[str] = None,
+                             scope: Optional[AccessScope] = None,
+                             recall: Optional[str] = None,
+                             mode: str = VECTOR_SEARCH_MODE,
+                             precision: Optional[str] = None,
+                             oversample: Optional[int] = None,
+                             with_embeddings: bool = False) -> List[List[ScoredNode]]:
+        '''
+        Runs the top k search for every query in a single statement. Results are grouped per query, in the same order as queries
+        '''
+        if len(queries) == 0:
+            return []
+
+        params = []
+        embeddings = _add_param(params, [query.embedding for query in queries])
+        texts = _add_param(params, [query.q for query in queries])
+        k_param = _add_param(params, k)
+        nearest_neighbours_sql = self._top_k_sql(embedding="q.embedding", text="q.text", k=k_param,
+                                                 conditions=self._filter_conditions(params, doc_filter, scope), mode=mode,
+                                    precision=precision or self.precision, oversample=oversample, with_embeddings=with_embeddings)
+
+        # each query is unnested into its own row and joined against its own nearest neighbours
+        sql_query = "SELECT q.query_idx, nn.node_id, nn.text, nn.metadata_, nn.cosine_similarity" + \
+            (", nn.embedding" if with_embeddings else "") + \
+            " FROM unnest(" + embeddings + "::vector[], " + texts + "::text[]) WITH ORDINALITY AS q(embedding, text, query_idx)" + \
+            " CROSS JOIN LATERAL (" + nearest_neighbours_sql + ") nn" + \
+            " ORDER BY q.query_idx, nn.search_score DESC"
+
+        async with self._search_connection(recall=recall) as conn:
+            result = await conn.fetch(sql_query, *params)
+
+        grouped_results = [[] for _ in queries]
+        for row in result:
+            # ordinality is 1-based
+            grouped_results[row['query_idx'] - 1].append(self._to_scored_node(row))
+        return grouped_results
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from cachetools import LRUCache
+
+from Database import Database
+from Node import bulk_embed_texts
+
+# ~6KB per float32 embedding, so ~25MB per process
+DEFAULT_LRU_SIZE = 4096
+EMBEDDING_CACHE_TABLE = "embedding_cache"
+
+
+def normalize_text(text: str) -> str:
+    '''
+    Queries that only differ in case, unicode form or whitespace share an embedding
+    '''
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache():
+    '''
+    Two tier cache in front of the embedding API: an in-process LRU, then the embedding_cache table shared by every process.
+    Misses of both tiers are embedded in a single batched API call and written back to both
+    '''
+    db: Database
+    normalize: bool
+    lru: LRUCache
+
+    def __init__(self, db: Database, lru_size: int = DEFAULT_LRU_SIZE, normalize: bool = True):
+        self.db = db
+        # queries are normalized, document chunks have to be embedded exactly as they are
+        self.normalize = normalize
+        self.lru = LRUCache(maxsize=lru_size)
+        # (model, hash) -> future of embeddings being fetched, so concurrent requests for the same text share one call
+        self._pending: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _key(self, model: str, text: str) -> Tuple[str, str]:
+        return (model, content_hash(normalize_text(text) if self.normalize else text))
+
+    async def _fetch(self, model: str, keys: List[Tuple[str, str]], texts: List[str]) -> List[np.ndarray]:
+        hashes = [key[1] for key in keys]
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("SELECT content_hash, embedding FROM " + EMBEDDING_CACHE_TABLE +
+                                    " WHERE model = $1 AND content_hash = ANY($2::text[])", model, hashes)
+        stored = {row['content_hash']: np.asarray(row['embedding'], dtype=np.float32) for row in rows}
+        self.db_hits += len(stored)
+
+        missing = [i for i, hash in enumerate(hashes) if hash not in stored]
+        if len(missing) > 0:
+            self.misses += len(missing)
+            embedded = [np.asarray(embedding, dtype=np.float32) for embedding in
+                        await bulk_embed_texts(texts=[texts[i] for i in missing], embedding_model=model)]
+            async with self.db.acquire() as conn:
+                await conn.execute("INSERT INTO " + EMBEDDING_CACHE_TABLE + " (model, content_hash, embedding)" +
+                                   " SELECT $1, content_hash, embedding FROM unnest($2::text[], $3::vector[]) AS e(content_hash, embedding)" +
+                                   " ON CONFLICT DO NOTHING",
+                                   model, [hashes[i] for i in missing], embedded)
+            stored.update(zip([hashes[i] for i in missing], embedded))
+
+        return [stored[hash] for hash in hashes]
+
+    async def embed_many(self, model: str, texts: List[str]) -> List[np.ndarray]:
+        '''
+        Embeddings of the texts, in order
+        '''
+        keys = [self._key(model, text) for text in texts]
+
+        embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
+        waiting = []
+        to_fetch = {}
+        for i, key in enumerate(keys):
+            if key in self.lru:
+                self.hits += 1
+                embeddings[i] = self.lru[key]
+            elif key in self._pending:
+                waiting.append((i, self._pending[key]))
+            elif key not in to_fetch:
+                to_fetch[key] = texts[i]
+
+        if len(to_fetch) > 0:
+            loop = asyncio.get_running_loop()
+            fetch_keys = list(to_fetch.keys())
+            futures = {key: loop.create_future() for key in fetch_keys}
+            self._pending.update(futures)
+            try:
+                fetched = await self._fetch(model, fetch_keys, list(to_fetch.values()))
+                for key, embedding in zip(fetch_keys, fetched):
+                    self.lru[key] = embedding
+                    futures[key].set_result(embedding)
+            except Exception as e:
+                for future in futures.values():
+                    future.set_exception(e)
+                    # retrieve it, so requests that weren't waiting on it don't log "exception was never retrieved"
+                    future.exception()
+                raise
+            finally:
+                for key, future in futures.items():
+                    # cancelled while fetching (CancelledError isn't an Exception): nothing will resolve the future,
+                    # so it is cancelled and its waiters fetch the text themselves
+                    if not future.done():
+                        future.cancel()
+                    self._pending.pop(key, None)
+
+            for i, key in enumerate(keys):
+                if embeddings[i] is None and key in futures:
+                    embeddings[i] = futures[key].result()
+
+        for i, future in waiting:
+            try:
+                # shielded, so cancelling this request doesn't cancel the future other requests wait on
+                embeddings[i] = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # re-raised if this request was cancelled itself rather than the one fetching the text
+                if not future.cancelled() or asyncio.current_task().cancelling() > 0:
+                    raise
+                embeddings[i] = await self.embed(model, texts[i])
+
+        return embeddings
+
+    async def embed(self, model: str, text: str) -> np.ndarray:
+        return (await self.embed_many(model, [text]))[0]
+
+    async def prune(self, max_age_days: int) -> int:
+        '''
+        Deletes stored embeddings older than max_age_days, returns how many were deleted
+        '''
+        async with self.db.acquire() as conn:
+            status = await conn.execute("DELETE FROM " + EMBEDDING_CACHE_TABLE +
+                                        " WHERE created_at < now() - make_interval(days => $1)", max_age_days)
+        # status is "DELETE <rows>"
+        return int(status.split()[-1])
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"EmbeddingCache(size={len(self.lru)}, hits={self.hits}, db_hits={self.db_hits}, misses={self.misses})"
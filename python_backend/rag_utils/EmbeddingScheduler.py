@@ -0,0 +1,195 @@
+import asyncio
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import tiktoken
+
+from LiteLLM import LiteLLM
+
+# per model request limits of the provider and the rate limits of our account tier
+EMBEDDING_MODEL_LIMITS = {
+    "openai:embeddings": {
+        "encoding": "cl100k_base",
+        "max_input_tokens": 8191,
+        "max_batch_inputs": 2048,
+        "max_batch_tokens": 300_000,
+        "requests_per_minute": 3000,
+        "tokens_per_minute": 1_000_000,
+    },
+}
+DEFAULT_MODEL_LIMITS = EMBEDDING_MODEL_LIMITS["openai:embeddings"]
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_RETRIES = 6
+# full jitter backoff: sleep a random time up to min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2^attempt)
+BASE_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 30.0
+
+try:
+    # litellm raises the openai client's exceptions (or subclasses of them), APITimeoutError is an APIConnectionError
+    from openai import APIConnectionError
+    CONNECTION_ERRORS = (asyncio.TimeoutError, ConnectionError, APIConnectionError)
+except ImportError:
+    CONNECTION_ERRORS = (asyncio.TimeoutError, ConnectionError)
+
+
+class TokenBucket():
+    '''
+    Allows up to per_minute units a minute, refilled continuously. Waiters are served in order
+    '''
+    capacity: float
+    rate: float
+    tokens: float
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float):
+        # a single request larger than the bucket still goes through once the bucket is full
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+def _is_retryable(e: Exception) -> bool:
+    # connection errors, timeouts, rate limits and server errors are transient. Anything else (a bad request, a bad key,
+    # a bug of ours) fails the same way on every attempt
+    if isinstance(e, CONNECTION_ERRORS):
+        return True
+    status_code = getattr(e, 'status_code', None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+class EmbeddingScheduler():
+    '''
+    Embeds texts in batches packed by token count, with bounded concurrency, request and token rate limits,
+    and retries with jittered backoff. Shared by everything embedding with the same model in the process, see get_embedding_scheduler
+    '''
+    model: str
+    limits: Dict[str, Any]
+    max_retries: int
+    encoding: tiktoken.Encoding
+
+    def __init__(self,
+                 model: str,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES):
+        self.model = model
+        self.limits = EMBEDDING_MODEL_LIMITS.get(model, DEFAULT_MODEL_LIMITS)
+        self.max_retries = max_retries
+        self.encoding = tiktoken.get_encoding(self.limits['encoding'])
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._request_bucket = TokenBucket(
+            requests_per_minute or self.limits['requests_per_minute'])
+        self._token_bucket = TokenBucket(
+            tokens_per_minute or self.limits['tokens_per_minute'])
+
+        self.requests = 0
+        self.tokens = 0
+        self.retries = 0
+
+    def _prepare(self, texts: List[str]) -> Tuple[List[str], List[List[int]], List[int]]:
+        '''
+        Truncates texts over the model's input limit and packs their indices into batches, returns the texts, batches
+        and token count of every batch
+        '''
+        max_input_tokens = self.limits['max_input_tokens']
+        max_batch_inputs = self.limits['max_batch_inputs']
+        max_batch_tokens = self.limits['max_batch_tokens']
+
+        prepared_texts = []
+        batches = []
+        batch_token_counts = []
+        batch = []
+        batch_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = self.encoding.encode(text, disallowed_special=())
+            if len(tokens) > max_input_tokens:
+                tokens = tokens[:max_input_tokens]
+                text = self.encoding.decode(tokens)
+            prepared_texts.append(text)
+
+            if len(batch) > 0 and (len(batch) == max_batch_inputs or batch_tokens + len(tokens) > max_batch_tokens):
+                batches.append(batch)
+                batch_token_counts.append(batch_tokens)
+                batch = []
+                batch_tokens = 0
+            batch.append(i)
+            batch_tokens += len(tokens)
+
+        if len(batch) > 0:
+            batches.append(batch)
+            batch_token_counts.append(batch_tokens)
+        return prepared_texts, batches, batch_token_counts
+
+    async def _embed_batch(self, texts: List[str], token_count: int) -> List[List[float]]:
+        attempt = 0
+        while True:
+            await self._request_bucket.acquire(1)
+            await self._token_bucket.acquire(token_count)
+            try:
+                async with self._semaphore:
+                    embedding_obj = await LiteLLM.aembedding(model=self.model, input=texts)
+                self.requests += 1
+                self.tokens += token_count
+                return [data.embedding for data in embedding_obj.data]
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    raise
+            # backoff outside the semaphore, so other batches keep going
+            self.retries += 1
+            await asyncio.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt)))
+            attempt += 1
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        '''
+        Embeddings of the texts, in input order
+        '''
+        if len(texts) == 0:
+            return []
+
+        # tokenizing a large sync takes a while, keep it off the event loop
+        prepared_texts, batches, batch_token_counts = await asyncio.to_thread(self._prepare, texts)
+
+        batch_embeddings = await asyncio.gather(*[
+            self._embed_batch([prepared_texts[i] for i in batch], token_count)
+            for batch, token_count in zip(batches, batch_token_counts)])
+
+        embeddings = [None] * len(texts)
+        for batch, embedded in zip(batches, batch_embeddings):
+            for i, embedding in zip(batch, embedded):
+                embeddings[i] = embedding
+        return embeddings
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"EmbeddingScheduler(model={self.model}, requests={self.requests}, tokens={self.tokens}, retries={self.retries})"
+
+
+_schedulers: Dict[str, EmbeddingScheduler] = {}
+
+
+def get_embedding_scheduler(model: str) -> EmbeddingScheduler:
+    '''
+    The process wide scheduler of a model, rate limits only hold if every embedding call goes through it
+    '''
+    if model not in _schedulers:
+        _schedulers[model] = EmbeddingScheduler(model=model)
+    return _schedulers[model]
@@ -0,0 +1,46 @@
+from typing import List
+
+import numpy as np
+
+from Node import ScoredNode
+from Query import Query
+
+# weight of relevance to the query against novelty, 1 is plain top k
+DEFAULT_MMR_LAMBDA = 0.7
+
+
+def mmr_select(query: Query, candidates: List[ScoredNode], k: int, lambda_mult: float = DEFAULT_MMR_LAMBDA) -> List[ScoredNode]:
+    '''
+    Maximal marginal relevance: greedily picks k of the candidates, each maximizing
+    lambda_mult * sim(query, candidate) - (1 - lambda_mult) * max sim(candidate, picked),
+    so near duplicates (overlapping chunks, the same page synced from two sources) don't crowd out the rest.
+    The candidates need their embeddings (get_top_k with with_embeddings=True), picks are returned in selection order
+    '''
+    if len(candidates) <= k:
+        return candidates
+    if any(candidate.node.embedding is None for candidate in candidates):
+        raise ValueError("MMR needs the embeddings of all candidates")
+
+    embeddings = np.array([candidate.node.embedding for candidate in candidates], dtype=np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    # divided out of place, the query's embedding may be the cached array itself
+    query_embedding = np.asarray(query.embedding, dtype=np.float32)
+    query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+
+    relevance = embeddings @ query_embedding
+    similarity = embeddings @ embeddings.T
+
+    selected = [int(np.argmax(relevance))]
+    # highest similarity of every candidate to any selected one, updated with one row per pick
+    max_similarity = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        available[pick] = False
+        np.maximum(max_similarity, similarity[pick], out=max_similarity)
+
+    return [candidates[i] for i in selected]
@@ -0,0 +1,414 @@
+import asyncio
+import fcntl
+import json
+import mmap
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from AccessScope import AccessScope
+from Database import Database, CHUNKS_CHANGED_CHANNEL, EMBEDDING_DIMENSIONS, VECTOR_SEARCH_MODE
+from Node import Node, ScoredNode, json_loads
+from Query import Query
+
+DEFAULT_SNAPSHOT_DIR = "./snapshots"
+MANIFEST_FILE = "manifest.json"
+# bumped when the segment files change, snapshots of another version are rebuilt on the next refresh
+SNAPSHOT_VERSION = 3
+LOCK_FILE = "snapshot.lock"
+# rows fetched per round trip while writing a segment
+FETCH_BATCH_SIZE = 1000
+# the snapshot is rewritten from scratch once this share of its rows is deleted or it has this many segments
+COMPACTION_DELETED_RATIO = 0.2
+COMPACTION_MAX_SEGMENTS = 8
+# sync scripts notify once per document, so wait for a burst of notifications to settle before refreshing
+REFRESH_DEBOUNCE_SECONDS = 2.0
+
+
+class Segment():
+    '''
+    An immutable slice of the snapshot. Every file is memory mapped read only, so worker processes share the same pages
+    '''
+    name: str
+    embeddings: np.ndarray
+    row_ids: np.ndarray
+    doc_ids: np.ndarray
+    user_ids: np.ndarray
+    offsets: np.ndarray
+    acl_principals: np.ndarray
+    acl_indptr: np.ndarray
+    acl_indices: np.ndarray
+
+    def __init__(self, snapshot_path: str, name: str):
+        prefix = os.path.join(snapshot_path, name)
+        self.name = name
+        # unit length rows, so a dot product is the cosine similarity
+        self.embeddings = np.load(prefix + ".npy", mmap_mode='r')
+        self.row_ids = np.load(prefix + ".ids.npy", mmap_mode='r')
+        # metadata "id" of every row, for doc filters
+        self.doc_ids = np.load(prefix + ".docs.npy", mmap_mode='r')
+        # metadata "user_id" of every row, so a snapshot of several tenants only answers each tenant from its own rows
+        self.user_ids = np.load(prefix + ".users.npy", mmap_mode='r')
+        # byte offsets of every row in the jsonl sidecar
+        self.offsets = np.load(prefix + ".offsets.npy", mmap_mode='r')
+        # acl of every row in CSR form: row i may be read by acl_principals[acl_indices[acl_indptr[i]:acl_indptr[i + 1]]]
+        self.acl_principals = np.load(prefix + ".acl.npy", mmap_mode='r')
+        self.acl_indptr = np.load(prefix + ".acl_indptr.npy", mmap_mode='r')
+        self.acl_indices = np.load(prefix + ".acl_indices.npy", mmap_mode='r')
+        with open(prefix + ".jsonl", "rb") as rows_file:
+            self._rows = mmap.mmap(rows_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+    def row(self, index: int) -> Dict[str, Any]:
+        return json_loads(self._rows[self.offsets[index]:self.offsets[index + 1]])
+
+    def readable_mask(self, principals: List[str]) -> np.ndarray:
+        '''
+        Which rows have at least one of the principals in their acl
+        '''
+        allowed_principals = np.isin(self.acl_principals, principals)
+        # every acl has at least one entry except those of unparseable restrictions, which nobody may read
+        row_lengths = np.diff(self.acl_indptr)
+        mask = np.zeros(len(row_lengths), dtype=bool)
+        non_empty = row_lengths > 0
+        mask[non_empty] = np.logical_or.reduceat(
+            allowed_principals[self.acl_indices], self.acl_indptr[:-1][non_empty])
+        return mask
+
+
+class Snapshot():
+    '''
+    The segments of one manifest with their live row masks. Replaced as a whole when the manifest changes, so a search
+    holding one never mixes the segments of one manifest with the masks of another
+    '''
+    segments: List[Segment]
+    live_masks: List[Optional[np.ndarray]]
+    manifest_mtime: Optional[int]
+
+    def __init__(self, segments: List[Segment], live_masks: List[Optional[np.ndarray]], manifest_mtime: Optional[int]):
+        self.segments = segments
+        self.live_masks = live_masks
+        self.manifest_mtime = manifest_mtime
+
+
+class MemoryMappedDatabase():
+    '''
+    Exact, in-process top k search over a memory mapped snapshot of a tenant's chunks.
+    Has the same search interface as Database, and is faster than a round trip to pgvector for small tenants
+    '''
+    db: Database
+    user_id: Optional[str]
+    snapshot_path: str
+    snapshot: Snapshot
+
+    def __init__(self, db: Database, user_id: Optional[str] = None, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR):
+        self.db = db
+        self.user_id = user_id
+        self.snapshot_path = os.path.join(
+            snapshot_dir, db.vector_store_table, user_id or "all")
+        self.snapshot = Snapshot(segments=[], live_masks=[], manifest_mtime=None)
+
+        # searches run in worker threads, only one of them loads a new manifest
+        self._load_lock = threading.Lock()
+        self._refresh_task = None
+        self._refresh_requested = False
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.snapshot_path, MANIFEST_FILE)
+
+    def _read_manifest(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._manifest_path(), "r") as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return None
+
+    def _write_manifest(self, manifest: Dict[str, Any]):
+        # write then rename, so readers never see a partial manifest
+        tmp_path = self._manifest_path() + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_path, self._manifest_path())
+
+    def _load(self, force: bool = False) -> Snapshot:
+        '''
+        Picks up the latest manifest if it changed since the last search, returns the current snapshot
+        '''
+        with self._load_lock:
+            snapshot = self.snapshot
+            try:
+                mtime = os.stat(self._manifest_path()).st_mtime_ns
+            except FileNotFoundError:
+                return snapshot
+            if mtime == snapshot.manifest_mtime and not force:
+                return snapshot
+
+            manifest = self._read_manifest()
+            if manifest is None or manifest.get('version') != SNAPSHOT_VERSION:
+                return snapshot
+            loaded_segments = {segment.name: segment for segment in snapshot.segments}
+            try:
+                segments = [loaded_segments.get(name) or Segment(self.snapshot_path, name)
+                            for name in manifest['segments']]
+            except FileNotFoundError:
+                # the snapshot was compacted between reading the manifest and opening its segments, retry on the next search
+                return snapshot
+
+            deleted_ids = np.array(manifest['deleted_ids'], dtype=np.int64)
+            live_masks = [None if len(deleted_ids) == 0 else ~np.isin(segment.row_ids, deleted_ids)
+                          for segment in segments]
+            self.snapshot = Snapshot(segments=segments, live_masks=live_masks, manifest_mtime=mtime)
+            return self.snapshot
+
+    def _tenant_condition(self, params: List[Any]) -> str:
+        if self.user_id is None:
+            return ""
+        params.append(self.user_id)
+        return f" AND metadata_ ->> 'user_id' = ${len(params)}"
+
+    async def _write_segment(self, conn, name: str, new_ids: np.ndarray):
+        '''
+        Streams the rows with the new ids into a new segment, without holding the whole matrix in memory
+        '''
+        row_count = len(new_ids)
+        prefix = os.path.join(self.snapshot_path, name)
+        embeddings = np.lib.format.open_memmap(prefix + ".npy", mode='w+', dtype=np.float32,
+                                               shape=(row_count, EMBEDDING_DIMENSIONS))
+        row_ids = np.empty(row_count, dtype=np.int64)
+        offsets = np.zeros(row_count + 1, dtype=np.int64)
+        doc_ids = []
+        user_ids = []
+        acl_principals = {}
+        acl_indptr = np.zeros(row_count + 1, dtype=np.int64)
+        acl_indices = []
+
+        params = [new_ids.tolist()]
+        sql_query = "SELECT id, node_id, text, metadata_, embedding, acl FROM " + self.db.vector_store_table + \
+            " WHERE id = ANY($1::bigint[]) AND embedding IS NOT NULL" + \
+            self._tenant_condition(params) + " ORDER BY id"
+
+        with open(prefix + ".jsonl", "wb") as rows_file:
+            index = 0
+            async for row in conn.cursor(sql_query, *params, prefetch=FETCH_BATCH_SIZE):
+                embedding = np.asarray(row['embedding'], dtype=np.float32)
+                norm = np.linalg.norm(embedding)
+                embeddings[index] = embedding / norm if norm > 0 else embedding
+                row_ids[index] = row['id']
+                metadata = row['metadata_'] or {}
+                doc_ids.append(metadata.get('id') or "")
+                user_ids.append(metadata.get('user_id') or "")
+                for principal in row['acl'] or []:
+                    acl_indices.append(acl_principals.setdefault(
+                        principal, len(acl_principals)))
+                acl_indptr[index + 1] = len(acl_indices)
+
+                line = json.dumps({
+                    "node_id": row['node_id'],
+                    "text": row['text'],
+                    "metadata": metadata,
+                }).encode() + b"\n"
+                rows_file.write(line)
+                offsets[index + 1] = offsets[index] + len(line)
+                index += 1
+
+        embeddings.flush()
+        del embeddings
+        np.save(prefix + ".ids.npy", row_ids)
+        np.save(prefix + ".docs.npy", np.array(doc_ids, dtype=str))
+        np.save(prefix + ".users.npy", np.array(user_ids, dtype=str))
+        np.save(prefix + ".offsets.npy", offsets)
+        np.save(prefix + ".acl.npy", np.array(list(acl_principals.keys()), dtype=str))
+        np.save(prefix + ".acl_indptr.npy", acl_indptr)
+        np.save(prefix + ".acl_indices.npy", np.array(acl_indices, dtype=np.int64))
+
+    def _remove_segment_files(self, name: str):
+        for suffix in [".npy", ".ids.npy", ".docs.npy", ".users.npy", ".offsets.npy", ".acl.npy", ".acl_indptr.npy", ".acl_indices.npy", ".jsonl"]:
+            try:
+                # processes that still have the files mapped keep reading them until they reload the manifest
+                os.remove(os.path.join(self.snapshot_path, name + suffix))
+            except FileNotFoundError:
+                pass
+
+    async def refresh(self, full: bool = False) -> bool:
+        '''
+        Brings the snapshot up to date with the vector store: new rows are appended as a segment, deleted rows are masked out.
+        Returns False if another process is already refreshing the snapshot
+        '''
+        os.makedirs(self.snapshot_path, exist_ok=True)
+        with open(os.path.join(self.snapshot_path, LOCK_FILE), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # the other process's manifest is picked up on the next search
+                return False
+
+            # re-read under the lock, another process may have refreshed already
+            snapshot = self._load(force=True)
+            manifest = self._read_manifest()
+
+            params = []
+            live_ids_query = "SELECT coalesce(array_agg(id), '{}') FROM " + self.db.vector_store_table + \
+                " WHERE embedding IS NOT NULL" + self._tenant_condition(params)
+
+            async with self.db.acquire() as conn:
+                # one consistent view of the table for the deleted rows and the new rows
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    live_ids = np.array(await conn.fetchval(live_ids_query, *params), dtype=np.int64)
+
+                    snapshot_ids = np.concatenate([np.asarray(segment.row_ids) for segment in snapshot.segments] or
+                                                  [np.array([], dtype=np.int64)])
+                    deleted_ids = snapshot_ids[~np.isin(snapshot_ids, live_ids)]
+
+                    rebuild = full or manifest is None or manifest.get('version') != SNAPSHOT_VERSION or \
+                        len(snapshot.segments) >= COMPACTION_MAX_SEGMENTS or \
+                        (len(snapshot_ids) > 0 and len(deleted_ids) / len(snapshot_ids) > COMPACTION_DELETED_RATIO)
+
+                    if rebuild:
+                        segment_names = []
+                        deleted_ids = np.array([], dtype=np.int64)
+                        snapshot_ids = np.array([], dtype=np.int64)
+                    else:
+                        segment_names = list(manifest['segments'])
+
+                    # every live row the snapshot doesn't have, not just ids above the last refresh: ids are taken
+                    # when rows are inserted but become visible when their sync commits, so they don't arrive in order
+                    new_ids = np.setdiff1d(live_ids, snapshot_ids)
+                    if len(new_ids) > 0:
+                        name = f"segment-{int(time.time() * 1000)}-{os.getpid()}"
+                        await self._write_segment(conn, name, new_ids)
+                        segment_names.append(name)
+
+            self._write_manifest({
+                "version": SNAPSHOT_VERSION,
+                "segments": segment_names,
+                "deleted_ids": deleted_ids.tolist(),
+            })
+
+            if rebuild and manifest is not None:
+                for name in manifest['segments']:
+                    self._remove_segment_files(name)
+
+            self._load()
+        return True
+
+    async def listen(self):
+        '''
+        Refreshes the snapshot whenever the sync scripts report rewritten chunks for this tenant
+        '''
+        await self.db.listen(CHUNKS_CHANGED_CHANNEL, self._on_chunks_changed)
+
+    def _on_chunks_changed(self, payload: Dict[str, Any]):
+        if self.user_id is not None and payload.get('user_id') != self.user_id:
+            return
+        self._refresh_requested = True
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_when_settled())
+
+    async def _refresh_when_settled(self):
+        # keep going while notifications arrive during a refresh, so none of them are missed
+        while self._refresh_requested:
+            self._refresh_requested = False
+            await asyncio.sleep(REFRESH_DEBOUNCE_SECONDS)
+            await self.refresh()
+
+    def _search(self, queries: List[Query], k: int, doc_filter: Optional[List[str]], scope: Optional[AccessScope], with_embeddings: bool) -> List[List[ScoredNode]]:
+        snapshot = self._load()
+
+        query_matrix = np.stack([np.asarray(query.embedding, dtype=np.float32)
+                                for query in queries])
+        query_norms = np.linalg.norm(query_matrix, axis=1, keepdims=True)
+        query_norms[query_norms == 0] = 1
+        query_matrix /= query_norms
+
+        doc_filter_ids = None if doc_filter is None else np.array(
+            list(doc_filter), dtype=str)
+
+        # best k of every segment for every query, merged below
+        candidate_scores = []
+        candidate_segments = []
+        candidate_rows = []
+        for segment_idx, (segment, live_mask) in enumerate(zip(snapshot.segments, snapshot.live_masks)):
+            # (rows, queries)
+            scores = segment.embeddings @ query_matrix.T
+
+            mask = live_mask
+            if doc_filter_ids is not None:
+                doc_mask = np.isin(segment.doc_ids, doc_filter_ids)
+                mask = doc_mask if mask is None else mask & doc_mask
+            if scope is not None:
+                # "public" and "domain" acl entries are only readable within the tenant
+                scope_mask = (segment.user_ids == scope.user_id) & segment.readable_mask(scope.principals())
+                mask = scope_mask if mask is None else mask & scope_mask
+            if mask is not None:
+                scores[~mask] = -np.inf
+
+            segment_k = min(k, scores.shape[0])
+            top_rows = np.argpartition(-scores, segment_k - 1, axis=0)[:segment_k]
+            candidate_scores.append(np.take_along_axis(scores, top_rows, axis=0))
+            candidate_segments.append(np.full(top_rows.shape, segment_idx))
+            candidate_rows.append(top_rows)
+
+        if len(candidate_scores) == 0:
+            return [[] for _ in queries]
+
+        candidate_scores = np.concatenate(candidate_scores)
+        candidate_segments = np.concatenate(candidate_segments)
+        candidate_rows = np.concatenate(candidate_rows)
+
+        results = []
+        for query_idx in range(len(queries)):
+            order = np.argsort(-candidate_scores[:, query_idx], kind='stable')[:k]
+            scored_nodes = []
+            for candidate_idx in order:
+                score = candidate_scores[candidate_idx, query_idx]
+                if score == -np.inf:
+                    break
+                segment = snapshot.segments[candidate_segments[candidate_idx, query_idx]]
+                row_idx = candidate_rows[candidate_idx, query_idx]
+                row = segment.row(row_idx)
+                # copied out of the memory map, so the node doesn't keep the segment's pages alive
+                embedding = np.array(segment.embeddings[row_idx]) if with_embeddings else None
+                scored_nodes.append(ScoredNode(node=Node(node_id=row['node_id'], text=row['text'], metadata=row['metadata'], embedding=embedding),
+                                               score=float(score)))
+            results.append(scored_nodes)
+        return results
+
+    async def get_top_k_many(self,
+                             queries: List[Query],
+                             k: int,
+                             doc_filter: List[str] = None,
+                             scope: Optional[AccessScope] = None,
+                             recall: Optional[str] = None,
+                             mode: str = VECTOR_SEARCH_MODE,
+                             precision: Optional[str] = None,
+                             oversample: Optional[int] = None,
+                             with_embeddings: bool = False) -> List[List[ScoredNode]]:
+        '''
+        Exact top k for every query with one matrix product per segment. recall, precision and oversample are
+        accepted for compatibility with Database and ignored, the search is always exact
+        '''
+        if mode != VECTOR_SEARCH_MODE:
+            raise ValueError(
+                "MemoryMappedDatabase only supports vector search")
+        if scope is not None and self.user_id is not None and scope.user_id != self.user_id:
+            raise ValueError(
+                f"Scope of user {scope.user_id} used on the snapshot of user {self.user_id}")
+        if len(queries) == 0:
+            return []
+        # numpy releases the GIL, so the matrix math doesn't block the event loop
+        return await asyncio.to_thread(self._search, queries, k, doc_filter, scope, with_embeddings)
+
+    async def get_top_k(self,
+                        query: Query,
+                        k: int,
+                        doc_filter: List[str] = None,
+                        scope: Optional[AccessScope] = None,
+                        recall: Optional[str] = None,
+                        mode: str = VECTOR_SEARCH_MODE,
+                        precision: Optional[str] = None,
+                        oversample: Optional[int] = None,
+                        with_embeddings: bool = False) -> List[ScoredNode]:
+        return (await self.get_top_k_many(queries=[query], k=k, doc_filter=doc_filter, scope=scope, mode=mode, with_embeddings=with_embeddings))[0]
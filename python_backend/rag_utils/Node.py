@@ -3,44 +3,65 @@ import json
 import uuid
 from typing import Dict, Any, List, Optional
 
+from EmbeddingScheduler import get_embedding_scheduler
 from LiteLLM import LiteLLM
 
-EMBEDDINGS_BATCH_SIZE = 100
+try:
+    # optional, several times faster on the large _node_content blobs
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 DEFAULT_NODE_EMBEDDING_MODEL = "openai:embeddings"
 EXCLUDED_ITEMS = ['_node_content', 'hash', 'start_char_idx', 'end_char_idx',
                   'text_template', 'metadata_template', 'metadata_separator', 'ref_doc_id', 'document_id', 'doc_id', '_node_type']
 
 
 class Node():
+    # no per instance __dict__: top k, candidate pools and message histories hold many of these
+    __slots__ = ('node_id', 'text', 'metadata', 'embedding', 'embedding_model',
+                 'excluded_llm_metadata_keys', '_content_str')
+
     node_id: str
     text: str
-    # note: it seems to become a string when it is fetched from the database
     metadata: Dict[str, Any]
     embedding: Optional[List[float]]
     embedding_model: str
+    excluded_llm_metadata_keys: List[str]
 
     def __init__(self, text: str, metadata: Dict[str, Any], embedding: List[float] = None, node_id: str = None, embedding_model: str = DEFAULT_NODE_EMBEDDING_MODEL):
 
         self.node_id = str(uuid.uuid4()) if node_id is None else node_id
         self.text = text
-        self.metadata = metadata
+        # json columns that weren't decoded by the driver come in as strings
+        if isinstance(metadata, (str, bytes)):
+            metadata = json_loads(metadata)
+        self.metadata = metadata if metadata is not None else {}
         self.embedding = embedding
         self.embedding_model = embedding_model
 
+        # parsed once here instead of on every prompt the node is rendered into
+        node_content = self.metadata.get('_node_content')
+        self.excluded_llm_metadata_keys = json_loads(node_content).get(
+            'excluded_llm_metadata_keys', []) if node_content else []
+        self._content_str = None
+
     async def embed(self):
         embedding_obj = await LiteLLM.aembedding(
             model=self.embedding_model, input=[self.text])
         self.embedding = embedding_obj.data[0].embedding
 
     def to_content_str(self):
-        d = json.loads(self.metadata['_node_content'])
-
-        metadata_str = "\n".join([
-            f"{k}: {v}" for k, v in self.metadata.items() if
-            k not in d['excluded_llm_metadata_keys'] and
-            k not in EXCLUDED_ITEMS])
+        # metadata and text are not changed once a node is loaded, so the rendered string is cached
+        if self._content_str is None:
+            metadata_str = "\n".join([
+                f"{k}: {v}" for k, v in self.metadata.items() if
+                k not in self.excluded_llm_metadata_keys and
+                k not in EXCLUDED_ITEMS])
 
-        return f"{metadata_str}\n\n{self.text}"
+            self._content_str = f"{metadata_str}\n\n{self.text}"
+        return self._content_str
 
     def content(self):
         return self.text
@@ -53,6 +74,8 @@ class Node():
 
 
 class ScoredNode():
+    __slots__ = ('node', 'score')
+
     node: Node
     score: float
 
@@ -70,24 +93,16 @@ class ScoredNode():
         return f"ScoredNode(node={self.node}, score={self.score})"
 
 
-async def _bulk_embed_nodes(nodes: List[Node], embedding_model: str = DEFAULT_NODE_EMBEDDING_MODEL):
-    # embed the nodes
-    texts = [node.text for node in nodes]
-    embedding_obj = await LiteLLM.aembedding(model=embedding_model, input=texts)
-    for i, node in enumerate(nodes):
-        node.embedding = embedding_obj.data[i].embedding
+async def bulk_embed_texts(texts: List[str], embedding_model: str = DEFAULT_NODE_EMBEDDING_MODEL) -> List[List[float]]:
+    '''
+    Embeds the texts through the model's shared scheduler (token packed batches, rate limited, retried). Embeddings come back in order
+    '''
+    return await get_embedding_scheduler(embedding_model).embed(texts)
 
 
 async def bulk_embed_nodes(nodes: List[Node], embedding_model: str = DEFAULT_NODE_EMBEDDING_MODEL):
-    # split into batches to process
-    node_batches = [nodes[i:i + EMBEDDINGS_BATCH_SIZE]
-                    for i in range(0, len(nodes), EMBEDDINGS_BATCH_SIZE)]
-
-    tasks = []
-    for node_batch in node_batches:
-        tasks.append(_bulk_embed_nodes(nodes=node_batch,
-                                       embedding_model=embedding_model))
-
-    await asyncio.gather(*tasks)
+    embeddings = await bulk_embed_texts(texts=[node.text for node in nodes], embedding_model=embedding_model)
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
 
     return nodes
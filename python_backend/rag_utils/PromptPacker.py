@@ -0,0 +1,150 @@
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+import tiktoken
+
+# prompt sizes we allow per model, well inside their context windows: latency grows with the prompt and the
+# completion needs room too (gpt-3.5-turbo has a 4k window, gpt-4-1106-preview 128k)
+PROMPT_MODEL_LIMITS = {
+    "openai:gpt-3.5": {
+        "encoding": "cl100k_base",
+        "max_prompt_tokens": 3000,
+    },
+    "openai:gpt-4": {
+        "encoding": "cl100k_base",
+        "max_prompt_tokens": 8000,
+    },
+}
+DEFAULT_PROMPT_MODEL_LIMITS = PROMPT_MODEL_LIMITS["openai:gpt-4"]
+# most of the budget left after the fixed text goes to sources, the history gets at most this share of it
+DEFAULT_HISTORY_SHARE = 0.3
+
+T = TypeVar('T')
+
+
+def by_rank(ranked_lists: List[List[T]], key: Callable[[T], str]) -> List[T]:
+    '''
+    The distinct items of several relevance ordered lists, first of every list first, then the second ones and so on.
+    Packed in this order, the budget drops the least relevant items of every list first
+    '''
+    items: Dict[str, T] = {}
+    for rank in range(max([len(ranked_list) for ranked_list in ranked_lists], default=0)):
+        for ranked_list in ranked_lists:
+            if rank < len(ranked_list):
+                items.setdefault(key(ranked_list[rank]), ranked_list[rank])
+    return list(items.values())
+
+
+class PromptUsage():
+    '''
+    Token usage of the last prompt of a kind: its size, the budget, and the sources and history messages it kept and dropped
+    '''
+    prompt: str
+    tokens: int
+    budget: int
+    sources: int
+    dropped_sources: int
+    history: int
+    dropped_history: int
+
+    def __init__(self, prompt: str, tokens: int, budget: int, sources: int, dropped_sources: int, history: int, dropped_history: int):
+        self.prompt = prompt
+        self.tokens = tokens
+        self.budget = budget
+        self.sources = sources
+        self.dropped_sources = dropped_sources
+        self.history = history
+        self.dropped_history = dropped_history
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"PromptUsage(prompt={self.prompt}, tokens={self.tokens}, budget={self.budget}, sources={self.sources}, " + \
+            f"dropped_sources={self.dropped_sources}, history={self.history}, dropped_history={self.dropped_history})"
+
+
+class PromptPacker():
+    '''
+    Fits prompts of a model into a token budget: the fixed text (instructions, query) always goes in, then the newest
+    history messages within history_share of what is left, then sources in relevance order while they fit.
+    The usage of every kind of prompt is kept in usage, see get_prompt_packer
+    '''
+    model: str
+    max_prompt_tokens: int
+    history_share: float
+    encoding: tiktoken.Encoding
+    usage: Dict[str, PromptUsage]
+
+    def __init__(self, model: str, max_prompt_tokens: Optional[int] = None, history_share: float = DEFAULT_HISTORY_SHARE):
+        limits = PROMPT_MODEL_LIMITS.get(model, DEFAULT_PROMPT_MODEL_LIMITS)
+        self.model = model
+        self.max_prompt_tokens = max_prompt_tokens or limits['max_prompt_tokens']
+        self.history_share = history_share
+        self.encoding = tiktoken.get_encoding(limits['encoding'])
+        self.usage = {}
+        self.prompts = 0
+        self.tokens = 0
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def pack(self,
+             prompt: str,
+             fixed: str,
+             sources: List[str] = None,
+             history: List[str] = None,
+             separator: str = "\n") -> Tuple[List[int], List[int]]:
+        '''
+        Indices of the sources (ordered by relevance) and history messages (oldest first) that fit the budget along with
+        the fixed text, in their original order. prompt names the kind of prompt the usage is recorded under
+        '''
+        sources = sources if sources is not None else []
+        history = history if history is not None else []
+        separator_tokens = self.count(separator)
+        tokens = self.count(fixed)
+
+        history_budget = int(max(0, self.max_prompt_tokens - tokens) * self.history_share)
+        kept_history = []
+        # newest first, the oldest messages are the first to go
+        for i in reversed(range(len(history))):
+            message_tokens = self.count(history[i]) + separator_tokens
+            if message_tokens > history_budget:
+                break
+            history_budget -= message_tokens
+            tokens += message_tokens
+            kept_history.append(i)
+        kept_history.reverse()
+
+        kept_sources = []
+        for i, source in enumerate(sources):
+            source_tokens = self.count(source) + separator_tokens
+            # a large source that doesn't fit may leave room for a smaller, less relevant one
+            if tokens + source_tokens > self.max_prompt_tokens:
+                continue
+            tokens += source_tokens
+            kept_sources.append(i)
+
+        self.usage[prompt] = PromptUsage(prompt=prompt, tokens=tokens, budget=self.max_prompt_tokens,
+                                         sources=len(kept_sources), dropped_sources=len(sources) - len(kept_sources),
+                                         history=len(kept_history), dropped_history=len(history) - len(kept_history))
+        self.prompts += 1
+        self.tokens += tokens
+        return kept_sources, kept_history
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"PromptPacker(model={self.model}, max_prompt_tokens={self.max_prompt_tokens}, prompts={self.prompts}, tokens={self.tokens})"
+
+
+_packers: Dict[str, PromptPacker] = {}
+
+
+def get_prompt_packer(model: str) -> PromptPacker:
+    '''
+    The process wide packer of a model, set its max_prompt_tokens at startup to change the model's budget
+    '''
+    if model not in _packers:
+        _packers[model] = PromptPacker(model=model)
+    return _packers[model]
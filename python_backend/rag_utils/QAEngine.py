@@ -1,29 +1,50 @@
 import asyncio
-from typing import List, Optional
-
-from Database import Database
+import json
+from typing import AsyncGenerator, List, Optional, Union
+
+from AccessScope import AccessScope
+from AnswerCache import AnswerCache
+from CandidatePool import CandidatePool
+from Database import Database, VECTOR_SEARCH_MODE
+from EmbeddingCache import EmbeddingCache
+from MMR import mmr_select, DEFAULT_MMR_LAMBDA
 from Reranker import Reranker
 from SubqueryEngine import SubQueryEngine
 from Query import Query
-from Node import Node
+from Node import Node, ScoredNode
 from LiteLLM import LiteLLM
 from DataEmitter import DataEmitter
 from Message import Message
+from PromptPacker import by_rank, get_prompt_packer
 
 DEFAULT_QA_MODEL = "openai:gpt-4"
+DEFAULT_TOP_K = 5
+# over-fetched for MMR to pick the DEFAULT_TOP_K most relevant yet distinct chunks from
+DEFAULT_CANDIDATE_K = 20
+# seconds pipelined subqueries wait for the next ones to be written, to be retrieved, reranked and answered with them
+DEFAULT_PIPELINE_WINDOW = 0.25
 SOURCE_SEPARATOR = "\n\n\n"
 NEWLINE = "\n"
+QA_INSTRUCTIONS = "Given the context information and message history, and not prior knowledge, answer the query. Be specific and use format the response with markdown syntax. Use lists if necessary."
+SUBQUERIES_QA_INSTRUCTIONS = "Given the context information and not prior knowledge, answer every question below using only the sources listed with it. Be specific and use format the responses with markdown syntax. Use lists if necessary.\n" + \
+    'Respond with a JSON object mapping each question number to its answer, e.g. {"1": "<answer to question 1>", "2": "<answer to question 2>"}'
+MERGE_INSTRUCTIONS = "Given the following pairs of subqueries and responses, merge the responses into a single response that answers the original query. Use markdown syntax to format the response. Use lists if necessary. \n"
 
 
 def generate_qa_prompt(query: Query, sources: List[Node], message_history: List[Message] = None):
     if message_history is None:
         message_history = []
     # Convert each message in the history to a string
-    history_str = "\n".join([msg.to_context_str() for msg in message_history])
+    history_strs = [msg.to_content_str() for msg in message_history]
+    source_strs = [source.to_content_str() for source in sources]
+
+    # keep the most relevant sources and the latest messages that fit the QA model's budget
+    kept_sources, kept_history = get_prompt_packer(DEFAULT_QA_MODEL).pack(
+        prompt="qa", fixed=query.q + QA_INSTRUCTIONS, sources=source_strs, history=history_strs, separator=SOURCE_SEPARATOR)
+    history_str = "\n".join([history_strs[i] for i in kept_history])
 
     # Combine the sources into a single string
-    sources_str = SOURCE_SEPARATOR.join(
-        [source.to_content_str() for source in sources])
+    sources_str = SOURCE_SEPARATOR.join([source_strs[i] for i in kept_sources])
 
     # Construct the prompt
     prompt = f"""\
@@ -32,7 +53,7 @@ Context information is below.
 {sources_str}
 """ \
 
-    if len(message_history) > 0:
+    if len(kept_history) > 0:
         prompt += f"""\
 Message History:
 {history_str}
@@ -40,20 +61,74 @@ Message History:
 """
 
     prompt += f"""\
-Given the context information and message history, and not prior knowledge, answer the query. Be specific and use format the response with markdown syntax. Use lists if necessary.
+{QA_INSTRUCTIONS}
 Query: {query.q}
 Answer: 
     """
     return prompt
 
 
+def generate_subqueries_qa_prompt(subqueries: List[Query], sources: List[List[Node]]):
+    # every chunk is listed once, the questions refer to theirs by number
+    unique_sources = by_rank(sources, key=lambda source: source.node_id)
+
+    kept_sources, _ = get_prompt_packer(DEFAULT_QA_MODEL).pack(
+        prompt="subqueries_qa", fixed=NEWLINE.join([subquery.q for subquery in subqueries]) + SUBQUERIES_QA_INSTRUCTIONS,
+        sources=[source.to_content_str() for source in unique_sources], separator=SOURCE_SEPARATOR)
+    source_numbers = {unique_sources[i].node_id: number + 1 for number, i in enumerate(kept_sources)}
+
+    sources_str = SOURCE_SEPARATOR.join(
+        [f"Source {number + 1}:{NEWLINE}{unique_sources[i].to_content_str()}" for number, i in enumerate(kept_sources)])
+    questions_str = NEWLINE.join(
+        [f"Question {index + 1} (sources {', '.join([str(source_numbers[source.node_id]) for source in subquery_sources if source.node_id in source_numbers])}): {subquery.q}"
+         for index, (subquery, subquery_sources) in enumerate(zip(subqueries, sources))])
+
+    prompt = f"""\
+Context information is below.
+----------------------------------
+{sources_str}
+----------------------------------
+{SUBQUERIES_QA_INSTRUCTIONS}
+{questions_str}
+Answer:
+"""
+    return prompt
+
+
+async def stream_tokens(response) -> AsyncGenerator[str, None]:
+    '''
+    The tokens of a streaming completion as they arrive
+    '''
+    async for chunk in response:
+        token = chunk.choices[0].delta.content
+        if token:
+            yield token
+
+
+async def stream_text(text: str) -> AsyncGenerator[str, None]:
+    yield text
+
+
+async def complete(prompt: str, use_stream: bool = False) -> Union[str, AsyncGenerator[str, None]]:
+    '''
+    The QA model's completion of the prompt, or with use_stream a generator of its tokens. The request is sent before
+    returning either way, so the first token is already on its way when the caller starts iterating
+    '''
+    messages = [{"role": "user", "content": prompt}]
+    if not use_stream:
+        return (await LiteLLM.acompletion(model=DEFAULT_QA_MODEL, messages=messages)).choices[0].message.content
+    return stream_tokens(await LiteLLM.acompletion(model=DEFAULT_QA_MODEL, messages=messages, stream=True))
+
+
 class SubQueryAndResponse():
     subquery: Query
     response: str
+    sources: List[Node]
 
-    def __init__(self, subquery: Query, response: str):
+    def __init__(self, subquery: Query, response: str, sources: List[Node] = None):
         self.subquery = subquery
         self.response = response
+        self.sources = sources if sources is not None else []
 
     def __repr__(self) -> str:
         return self.__str__()
@@ -66,16 +141,24 @@ def merge_subquery_responses_prompt(subquery_responses: List[SubQueryAndResponse
     if message_history is None:
         message_history = []
     # Convert each message in the history to a string
-    history_str = "\n".join([msg.to_context_str() for msg in message_history])
+    history_strs = [msg.to_content_str() for msg in message_history]
+    response_strs = [f"Subquery: {subquery_response.subquery.q}{NEWLINE}Response: {subquery_response.response}"
+                     for subquery_response in subquery_responses]
+
+    # subqueries come in the order the subquery model wrote them, the most important first
+    kept_responses, kept_history = get_prompt_packer(DEFAULT_QA_MODEL).pack(
+        prompt="merge", fixed=subquery_responses[0].subquery.q + MERGE_INSTRUCTIONS, sources=response_strs, history=history_strs,
+        separator=SOURCE_SEPARATOR)
+    history_str = "\n".join([history_strs[i] for i in kept_history])
 
     # Construct the prompt with subquery responses
     prompt = f"""\
-Given the following pairs of subqueries and responses, merge the responses into a single response that answers the original query. Use markdown syntax to format the response. Use lists if necessary. \n
-{SOURCE_SEPARATOR.join([f"Subquery: {subquery_response.subquery.q}{NEWLINE}Response: {subquery_response.response}" for subquery_response in subquery_responses])}
+{MERGE_INSTRUCTIONS}
+{SOURCE_SEPARATOR.join([response_strs[i] for i in kept_responses])}
 """
 
     # Add message history to the prompt if it exists
-    if len(message_history) > 0:
+    if len(kept_history) > 0:
         prompt += f"""\
 ------------------
 Message History:
@@ -96,40 +179,95 @@ class QAEngine():
     db: Database
     reranker: Reranker
     subquery_engine: SubQueryEngine
-
-    def __init__(self, db: Database, reranker: Reranker, subquery_engine: SubQueryEngine):
+    search_mode: str
+    embedding_cache: EmbeddingCache
+    answer_cache: Optional[AnswerCache]
+    mmr_lambda: Optional[float]
+    rerank_latency_budget: Optional[float]
+    pipeline_subqueries: bool
+    pipeline_window: float
+
+    def __init__(self, db: Database, reranker: Reranker, subquery_engine: SubQueryEngine, search_mode: str = VECTOR_SEARCH_MODE, embedding_cache: EmbeddingCache = None, answer_cache: AnswerCache = None,
+                 mmr_lambda: Optional[float] = DEFAULT_MMR_LAMBDA, rerank_latency_budget: Optional[float] = None, pipeline_subqueries: bool = False,
+                 pipeline_window: float = DEFAULT_PIPELINE_WINDOW):
         self.db = db
         self.reranker = reranker
         self.subquery_engine = subquery_engine
+        self.embedding_cache = embedding_cache if embedding_cache is not None else EmbeddingCache(db)
+        # answers to new questions of a scope (no history or doc filter) are looked up and stored here if set
+        self.answer_cache = answer_cache
+        # "hybrid" fuses full text and vector rankings, which helps keyword heavy queries (names, product codes)
+        self.search_mode = search_mode
+        # None turns off MMR, the top k then goes to the reranker as is
+        self.mmr_lambda = mmr_lambda
+        # seconds a query can spend on LLM reranking, the reranker's policy skips it when its latency is over budget
+        self.rerank_latency_budget = rerank_latency_budget
+        # by default the subqueries are retrieved, reranked and answered together once all are generated, one round trip and
+        # one prompt each. Pipelining starts on the subqueries while the next ones are generated, which cuts latency when the
+        # subquery model is slow. Only the subqueries written within pipeline_window seconds of each other are batched then,
+        # so it costs more retrieval, rerank and answer calls, and chunks shared across batches are sent once per prompt
+        self.pipeline_subqueries = pipeline_subqueries
+        self.pipeline_window = pipeline_window
+
+    def _candidate_k(self) -> int:
+        return DEFAULT_CANDIDATE_K if self.mmr_lambda is not None else DEFAULT_TOP_K
+
+    async def _retrieve(self, query: Query, doc_filter: List[str] = None, scope: AccessScope = None) -> List[ScoredNode]:
+        return await self.db.get_top_k(query=query, k=self._candidate_k(), doc_filter=doc_filter, scope=scope, mode=self.search_mode,
+                                       with_embeddings=self.mmr_lambda is not None)
+
+    def _with_speculative(self, candidates: List[ScoredNode], speculative_candidates: List[ScoredNode]) -> List[ScoredNode]:
+        '''
+        Adds the original query's candidates to a subquery's, for MMR to choose from
+        '''
+        node_ids = set([candidate.node.node_id for candidate in candidates])
+        return candidates + [candidate for candidate in speculative_candidates if candidate.node.node_id not in node_ids]
+
+    def _diversify(self, query: Query, candidates: List[ScoredNode]) -> List[ScoredNode]:
+        '''
+        Narrows the retrieved candidates down to the DEFAULT_TOP_K the reranker and QA prompts get
+        '''
+        if self.mmr_lambda is None:
+            return candidates[:DEFAULT_TOP_K]
+        return mmr_select(query=query, candidates=candidates, k=DEFAULT_TOP_K, lambda_mult=self.mmr_lambda)
 
     async def _answer(self,
                       query: Query,
                       sources: Optional[List[Node]],
                       use_stream: bool = False,
-                      message_history: List[Message] = None,):
-        # TODO: implement use Stream
+                      message_history: List[Message] = None,
+                      scope: AccessScope = None,) -> Union[str, AsyncGenerator[str, None]]:
         if sources is None:
-            sources = await self.reranker.llm_rerank(
-                query=query, choices=await self.db.get_top_k(query=query, k=5))
+            candidates = await self._retrieve(query=query, scope=scope)
+            sources = await self.reranker.rerank(
+                query=query, choices=self._diversify(query=query, candidates=candidates), latency_budget=self.rerank_latency_budget)
 
         completed_prompt = generate_qa_prompt(
             query=query, sources=sources, message_history=message_history)
-        llm_response = (await LiteLLM.acompletion(model=DEFAULT_QA_MODEL,
-                                                  messages=[{"role": "user", "content": completed_prompt}])).choices[0].message.content
-        return llm_response
-
-    async def _get_top_k_and_answer(self, subquery: Query, doc_filter: List[str] = None):
-        # get top k results
-        top_k_results = await self.db.get_top_k(query=subquery, k=5, doc_filter=doc_filter)
-        reranked_results = await self.reranker.llm_rerank(
-            query=subquery, choices=top_k_results)
-
-        if len(reranked_results) == 0:
-            return SubQueryAndResponse(subquery=subquery, response="")
-
-        # answer subquery
-        subquery_response = await self._answer(query=subquery, sources=reranked_results)
-        return SubQueryAndResponse(subquery=subquery, response=subquery_response)
+        return await complete(prompt=completed_prompt, use_stream=use_stream)
+
+    async def _answer_many(self, subqueries: List[Query], sources: List[List[Node]]) -> List[str]:
+        '''
+        Answers several subqueries with one prompt that sends the chunks they share once. A subquery left out of the
+        response is answered on its own
+        '''
+        if len(subqueries) == 1:
+            return [await self._answer(query=subqueries[0], sources=sources[0])]
+
+        completed_prompt = generate_subqueries_qa_prompt(subqueries=subqueries, sources=sources)
+        llm_response = (await LiteLLM.acompletion(model=DEFAULT_QA_MODEL, messages=[{"role": "user", "content": completed_prompt}],
+                                                  response_format={"type": "json_object"})).choices[0].message.content
+        try:
+            json_response = json.loads(llm_response)
+        except json.JSONDecodeError:
+            json_response = {}
+
+        responses = [json_response.get(str(index + 1)) for index in range(len(subqueries))]
+        missing = [i for i, response in enumerate(responses) if not isinstance(response, str)]
+        missing_responses = await asyncio.gather(*[self._answer(query=subqueries[i], sources=sources[i]) for i in missing])
+        for i, response in zip(missing, missing_responses):
+            responses[i] = response
+        return responses
 
     async def answer(self,
                      query: Query,
@@ -137,7 +275,12 @@ class QAEngine():
                      data_emitter: DataEmitter = None,
                      message_history: List[Message] = None,
                      doc_filter: List[str] = None,
-                     use_last_message_sources: bool = False):
+                     use_last_message_sources: bool = False,
+                     scope: AccessScope = None,
+                     use_stream: bool = False) -> Union[str, AsyncGenerator[str, None]]:
+        '''
+        The answer to the query, or with use_stream an async generator of the final answer's tokens as the model writes them
+        '''
         # enforce that if we are using last message sources, we do not need to generate subqueries used to find new sources
         if use_last_message_sources and use_subqueries:
             raise Exception(
@@ -151,35 +294,158 @@ class QAEngine():
             sources = list(set(sources))
 
         if not use_subqueries:
-            return await self._answer(query=query, sources=sources, message_history=message_history)
+            return await self._answer(query=query, sources=sources, use_stream=use_stream, message_history=message_history, scope=scope)
+
+        # only a question without context has an answer that can be reused for a similar question
+        use_answer_cache = self.answer_cache is not None and scope is not None and \
+            not message_history and doc_filter is None
+        if use_answer_cache:
+            cached_answer = await self.answer_cache.lookup(scope=scope, query=query)
+            if cached_answer is not None:
+                # the same shape as the subquery pairs of an uncached answer: the cache keeps the answer's sources, not its subqueries
+                if data_emitter:
+                    data_emitter.emit([SubQueryAndResponse(subquery=query, response=cached_answer.answer, sources=cached_answer.sources)])
+                return stream_text(cached_answer.answer) if use_stream else cached_answer.answer
+
+        # the original query is retrieved for while its subqueries are generated, to answer it directly if there are none
+        # and to widen the subqueries' candidates otherwise
+        speculative = asyncio.create_task(self._retrieve(query=query, doc_filter=doc_filter, scope=scope))
+        try:
+            if self.pipeline_subqueries:
+                subquery_pairs = await self._pipelined_subquery_pairs(
+                    query=query, message_history=message_history, doc_filter=doc_filter, scope=scope, data_emitter=data_emitter, speculative=speculative)
+            else:
+                subquery_pairs = await self._batched_subquery_pairs(
+                    query=query, message_history=message_history, doc_filter=doc_filter, scope=scope, data_emitter=data_emitter, speculative=speculative)
+        except BaseException:
+            speculative.cancel()
+            raise
+
+        if data_emitter:
+            data_emitter.emit(subquery_pairs)
+
+        if len(subquery_pairs) == 0:
+            # the subquery model replied "None"
+            sources = await self.reranker.rerank(
+                query=query, choices=self._diversify(query=query, candidates=await speculative), latency_budget=self.rerank_latency_budget)
+            llm_response = await self._answer(query=query, sources=sources, use_stream=use_stream, message_history=message_history, scope=scope)
+        else:
+            # merge subquery responses
+            sources = [source for pair in subquery_pairs for source in pair.sources]
+            completed_prompt = merge_subquery_responses_prompt(
+                subquery_responses=subquery_pairs, message_history=message_history)
+            llm_response = await complete(prompt=completed_prompt, use_stream=use_stream)
+
+        if use_answer_cache:
+            if use_stream:
+                return self._store_when_streamed(scope=scope, query=query, tokens=llm_response, sources=sources)
+            await self.answer_cache.store(scope=scope, query=query, answer=llm_response, sources=sources)
+
+        return llm_response
 
-        # generate subqueries
+    async def _batched_subquery_pairs(self, query: Query, message_history: List[Message], doc_filter: List[str], scope: AccessScope, data_emitter: DataEmitter,
+                                      speculative: asyncio.Task) -> List[SubQueryAndResponse]:
+        '''
+        Generates all subqueries, then embeds, retrieves, reranks and answers them as one batch each
+        '''
         generated_subqueries = await self.subquery_engine.generate_subqueries(
             query=query,
             message_history=message_history
         )
-        subqueries = [Query(q=subquery)
-                      for subquery in generated_subqueries if len(subquery) != 0]  # + [query]
-
-        if data_emitter:
-            data_emitter.emit(subqueries)
-
+        return await self._answer_subquery_batch(
+            qs=[subquery for subquery in generated_subqueries if len(subquery) != 0],  # + [query]
+            doc_filter=doc_filter, scope=scope, data_emitter=data_emitter, speculative=speculative, pool=CandidatePool())
+
+    async def _pipelined_subquery_pairs(self, query: Query, message_history: List[Message], doc_filter: List[str], scope: AccessScope, data_emitter: DataEmitter,
+                                        speculative: asyncio.Task) -> List[SubQueryAndResponse]:
+        '''
+        Starts on the subqueries while the subquery model is still writing the next ones. The subqueries written within
+        pipeline_window seconds of the first of a batch are embedded, retrieved, reranked and answered together
+        '''
+        # shared by the batches, so later batches drop subqueries duplicating an earlier batch and reuse its nodes
+        pool = CandidatePool()
+        written: asyncio.Queue = asyncio.Queue()
+
+        async def read_subqueries():
+            try:
+                async for q in self.subquery_engine.stream_subqueries(query=query, message_history=message_history):
+                    written.put_nowait(q)
+            finally:
+                written.put_nowait(None)
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.create_task(read_subqueries())
         tasks = []
-        for subquery in subqueries:
-            task = self._get_top_k_and_answer(
-                subquery=subquery, doc_filter=doc_filter)
-            tasks.append(task)
-
-        # Run tasks concurrently and wait for all of them to complete
-        subquery_pairs = await asyncio.gather(*tasks)
-
+        try:
+            done = False
+            while not done:
+                q = await written.get()
+                if q is None:
+                    break
+                batch = [q]
+                deadline = loop.time() + self.pipeline_window
+                while True:
+                    try:
+                        q = await asyncio.wait_for(written.get(), timeout=max(deadline - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        break
+                    if q is None:
+                        done = True
+                        break
+                    batch.append(q)
+                tasks.append(asyncio.create_task(self._answer_subquery_batch(
+                    qs=batch, doc_filter=doc_filter, scope=scope, data_emitter=data_emitter, speculative=speculative, pool=pool)))
+            # raises if the subquery model failed
+            await reader
+            batches = await asyncio.gather(*tasks)
+        except BaseException:
+            # the other subqueries are of no use without these (or the request was cancelled)
+            reader.cancel()
+            for task in tasks:
+                task.cancel()
+            raise
+        return [pair for subquery_pairs in batches for pair in subquery_pairs]
+
+    async def _answer_subquery_batch(self, qs: List[str], doc_filter: List[str], scope: AccessScope, data_emitter: DataEmitter,
+                                     speculative: asyncio.Task, pool: CandidatePool) -> List[SubQueryAndResponse]:
+        subqueries = await Query.create_many(qs=qs, embedding_cache=self.embedding_cache)
+        # near duplicate subqueries would only repeat the same retrieval and answer
+        subqueries = [subquery for subquery in subqueries if pool.add_subquery(subquery) is None]
+        if len(subqueries) == 0:
+            return []
+
+        # the client sees the subqueries as soon as they are kept, not once they are answered
         if data_emitter:
-            data_emitter.emit(subquery_pairs)
-
-        # merge subquery responses
-        completed_prompt = merge_subquery_responses_prompt(
-            subquery_responses=subquery_pairs, message_history=message_history)
-        llm_response = (await LiteLLM.acompletion(model=DEFAULT_QA_MODEL,
-                                                  messages=[{"role": "user", "content": completed_prompt}])).choices[0].message.content
+            data_emitter.emit(subqueries)
 
-        return llm_response
+        # retrieve for every subquery in a single round trip
+        subquery_top_k_results = await self.db.get_top_k_many(
+            queries=subqueries, k=self._candidate_k(), doc_filter=doc_filter, scope=scope, mode=self.search_mode,
+            with_embeddings=self.mmr_lambda is not None)
+
+        speculative_candidates = await speculative
+
+        # rerank every subquery's candidates in one batched prompt
+        subquery_reranked_results = await self.reranker.rerank_many(
+            queries=subqueries,
+            choices=[self._diversify(query=subquery, candidates=pool.add_candidates(self._with_speculative(top_k_results, speculative_candidates)))
+                     for subquery, top_k_results in zip(subqueries, subquery_top_k_results)],
+            latency_budget=self.rerank_latency_budget)
+
+        # answer the subqueries with sources together, in one prompt
+        answerable = [i for i, reranked_results in enumerate(subquery_reranked_results) if len(reranked_results) > 0]
+        responses = await self._answer_many(subqueries=[subqueries[i] for i in answerable],
+                                            sources=[subquery_reranked_results[i] for i in answerable]) if len(answerable) > 0 else []
+
+        subquery_pairs = [SubQueryAndResponse(subquery=subquery, response="") for subquery in subqueries]
+        for i, response in zip(answerable, responses):
+            subquery_pairs[i] = SubQueryAndResponse(subquery=subqueries[i], response=response, sources=subquery_reranked_results[i])
+        return subquery_pairs
+
+    async def _store_when_streamed(self, scope: AccessScope, query: Query, tokens: AsyncGenerator[str, None], sources: List[Node]) -> AsyncGenerator[str, None]:
+        answer = []
+        async for token in tokens:
+            answer.append(token)
+            yield token
+        # an answer cut short by the client going away isn't cached
+        await self.answer_cache.store(scope=scope, query=query, answer="".join(answer), sources=sources)
@@ -1,7 +1,12 @@
-from typing import List
+from typing import List, TYPE_CHECKING
 import numpy as np
 
 from LiteLLM import LiteLLM
+from Node import bulk_embed_texts
+
+if TYPE_CHECKING:
+    # EmbeddingCache imports Database, which imports Query
+    from EmbeddingCache import EmbeddingCache
 
 DEFAULT_QUERY_EMBEDDING_MODEL = "openai:embeddings"
 
@@ -12,6 +17,9 @@ class Query():
     embedding_model: str
 
     def __init__(self, q: str, embedding: np.array = None, query_embedding_model: str = DEFAULT_QUERY_EMBEDDING_MODEL):
+        '''
+        Embeds q with a blocking API call if no embedding is given. In async code use Query.create instead
+        '''
         if len(q) == 0:
             raise ValueError("Query cannot be empty")
 
@@ -23,6 +31,33 @@ class Query():
         else:
             self.embedding = np.array(embedding)
 
+    @classmethod
+    async def create(cls,
+                     q: str,
+                     embedding_cache: "EmbeddingCache" = None,
+                     query_embedding_model: str = DEFAULT_QUERY_EMBEDDING_MODEL) -> "Query":
+        return (await cls.create_many(qs=[q], embedding_cache=embedding_cache, query_embedding_model=query_embedding_model))[0]
+
+    @classmethod
+    async def create_many(cls,
+                          qs: List[str],
+                          embedding_cache: "EmbeddingCache" = None,
+                          query_embedding_model: str = DEFAULT_QUERY_EMBEDDING_MODEL) -> List["Query"]:
+        '''
+        Embeds all the queries with one batched, non blocking API call, skipping the ones found in the embedding cache
+        '''
+        if any(len(q) == 0 for q in qs):
+            raise ValueError("Query cannot be empty")
+        if len(qs) == 0:
+            return []
+
+        if embedding_cache is not None:
+            embeddings = await embedding_cache.embed_many(model=query_embedding_model, texts=qs)
+        else:
+            embeddings = await bulk_embed_texts(texts=qs, embedding_model=query_embedding_model)
+        return [cls(q=q, embedding=embedding, query_embedding_model=query_embedding_model)
+                for q, embedding in zip(qs, embeddings)]
+
     def __repr__(self) -> str:
         return self.__str__()
 
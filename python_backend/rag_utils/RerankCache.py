@@ -0,0 +1,76 @@
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from cachetools import TTLCache
+
+from Database import Database, CHUNKS_CHANGED_CHANNEL
+from EmbeddingCache import normalize_text
+from Node import ScoredNode
+
+DEFAULT_TTL_SECONDS = 60 * 60
+DEFAULT_MAX_ENTRIES = 4096
+
+RerankKey = Tuple[str, str, Tuple[str, ...]]
+
+
+class RerankCache():
+    '''
+    In-process cache of LLM rerankings, keyed by reranker model, normalized query and the ordered candidate node ids,
+    holding the parsed (doc, relevance) list. Entries expire after ttl_seconds, the least recently used go beyond max_entries,
+    and the entries ranking a chunk of a document are dropped when a sync rewrites it (see listen)
+    '''
+    ttl_seconds: int
+    max_entries: int
+    cache: TTLCache
+
+    def __init__(self, ttl_seconds: int = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (parsed response, doc ids of the candidates)
+        self.cache = TTLCache(maxsize=max_entries, ttl=ttl_seconds)
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _key(self, model: str, query: str, choices: List[ScoredNode]) -> RerankKey:
+        return (model, normalize_text(query), tuple([choice.node.node_id for choice in choices]))
+
+    def get(self, model: str, query: str, choices: List[ScoredNode]) -> Optional[List[Tuple[int, int]]]:
+        entry = self.cache.get(self._key(model, query, choices))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, model: str, query: str, choices: List[ScoredNode], parsed_response: List[Tuple[int, int]]):
+        doc_ids: FrozenSet[str] = frozenset([choice.node.metadata['doc_id'] for choice in choices
+                                             if choice.node.metadata.get('doc_id') is not None])
+        self.cache[self._key(model, query, choices)] = (parsed_response, doc_ids)
+
+    def invalidate(self, doc_ids: List[str]) -> int:
+        '''
+        Drops every ranking of a candidate from one of the documents, returns the number of dropped rankings
+        '''
+        doc_ids = set(doc_ids)
+        stale = [key for key, (_, entry_doc_ids) in list(self.cache.items())
+                 if not doc_ids.isdisjoint(entry_doc_ids)]
+        for key in stale:
+            self.cache.pop(key, None)
+        self.invalidations += len(stale)
+        return len(stale)
+
+    async def listen(self, db: Database):
+        '''
+        Invalidates the rankings of the documents the sync scripts report as rewritten
+        '''
+        await db.listen(CHUNKS_CHANGED_CHANNEL, self._on_chunks_changed)
+
+    def _on_chunks_changed(self, payload: Dict[str, Any]):
+        self.invalidate(payload.get('doc_ids', []))
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"RerankCache(ttl_seconds={self.ttl_seconds}, max_entries={self.max_entries}, size={len(self.cache)}, hits={self.hits}, misses={self.misses})"
@@ -1,13 +1,33 @@
-from typing import List, Tuple
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
 import json
+import random
+import time
 
 from Query import Query
 from Node import ScoredNode, Node
 from LiteLLM import LiteLLM
+from PromptPacker import by_rank, get_prompt_packer
+from RerankCache import RerankCache
 
 # TODO: Adjust the formatting so we reduce the probabiility of the documents having template-like text in them
 
 DEFAULT_LLM_RERANKER_MODEL = "openai:gpt-3.5"
+# reordering fewer chunks than this isn't worth an LLM round trip, used when the reranker keeps every chunk (no top_n)
+DEFAULT_MIN_CANDIDATES = 3
+# ada-002 similarities are compressed into ~0.7-1.0, a lead this large over the runner up is a clear winner
+DEFAULT_DOMINANT_SCORE_GAP = 0.05
+# weight of the latest LLM rerank in the moving average of its latency
+LATENCY_SMOOTHING = 0.2
+
+LLM_RERANK = "llm"
+SKIP_FEW_CANDIDATES = "few_candidates"
+SKIP_DOMINANT_SCORE = "dominant_score"
+SKIP_LATENCY_BUDGET = "latency_budget"
+# candidates of one batched rerank prompt, subqueries beyond it go into further prompts
+DEFAULT_MAX_BATCH_DOCS = 30
+# relevance of the candidates the prompt budget left out: the LLM never saw them, they follow its picks in retrieval order
+UNJUDGED_RELEVANCE = 0
 
 
 def generate_llm_reranker_prompt(context_str: str, query_str: str):
@@ -35,36 +55,366 @@ def generate_llm_reranker_prompt(context_str: str, query_str: str):
     return final_response
 
 
+def generate_llm_batch_reranker_prompt(context_str: str, questions_str: str):
+    response_template = (
+        "A list of documents is shown below. Each document has a number next to it along "
+        "with a summary of the document. A numbered list of questions is also provided. \n"
+        "For every question, respond with the numbers of the documents (without any additional info) "
+        "you should consult to answer the question, in order of relevance, as well \n"
+        "as the relevance score. The relevance score is a number from 1-10 based on "
+        "how relevant you think the document is to the question.\n"
+        "Do not include any documents that are not relevant to the question. \n"
+        "Example format: \n"
+        "Document 1:\n<summary of document 1>\n\n"
+        "Document 2:\n<summary of document 2>\n\n"
+        "...\n\n"
+        "Document 10:\n<summary of document 10>\n\n"
+        "Question 1: <question 1>\n"
+        "Question 2: <question 2>\n"
+        "Answer:\n"
+        '{"1": [{"doc": 9, "relevance": 7},{"doc": 3, "relevance": 4}], "2": [{"doc": 2, "relevance": 8}]}\n\n'
+        "Let's try this now: \n\n"
+    )
+
+    final_response = response_template + context_str + \
+        "\n" + questions_str + "\nAnswer:\n"
+    return final_response
+
+
+class RerankStats():
+    '''
+    How often each rerank path is taken, the LLM reranker's latency, and on the LLM path how often it kept the
+    retrieval order's best chunk first and how many chunks it dropped. LLM reranks answered by the rerank cache are
+    only counted in cache_hits. Audited skips (see RerankPolicy.audit_rate) tell how often skipping changed the best
+    chunk the answer is based on, audits whose LLM call failed are only counted in audit_failures
+    '''
+    decisions: Dict[str, int]
+    cache_hits: int
+    llm_latency: Optional[float]
+    llm_top_agreements: int
+    llm_dropped: int
+    audits: int
+    audit_top_agreements: int
+    audit_failures: int
+
+    def __init__(self):
+        self.decisions = {LLM_RERANK: 0, SKIP_FEW_CANDIDATES: 0,
+                          SKIP_DOMINANT_SCORE: 0, SKIP_LATENCY_BUDGET: 0}
+        self.cache_hits = 0
+        self.llm_latency = None
+        self.llm_top_agreements = 0
+        self.llm_dropped = 0
+        self.audits = 0
+        self.audit_top_agreements = 0
+        self.audit_failures = 0
+
+    def record_llm_rerank(self, latency: float, choices: List[ScoredNode], ranked: List[Node]):
+        self.llm_latency = latency if self.llm_latency is None else \
+            LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.llm_latency
+        if len(ranked) > 0 and ranked[0].node_id == choices[0].node.node_id:
+            self.llm_top_agreements += 1
+        self.llm_dropped += len(choices) - len(ranked)
+
+    def record_cache_hit(self):
+        self.cache_hits += 1
+
+    def record_audit(self, choices: List[ScoredNode], ranked: List[Node]):
+        self.audits += 1
+        if len(ranked) > 0 and ranked[0].node_id == choices[0].node.node_id:
+            self.audit_top_agreements += 1
+
+    def record_audit_failure(self):
+        self.audit_failures += 1
+
+    def skip_rate(self) -> float:
+        total = sum(self.decisions.values())
+        return 0.0 if total == 0 else 1 - self.decisions[LLM_RERANK] / total
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"RerankStats(decisions={self.decisions}, skip_rate={self.skip_rate():.2f}, cache_hits={self.cache_hits}, llm_latency={self.llm_latency}, " + \
+            f"llm_top_agreements={self.llm_top_agreements}, llm_dropped={self.llm_dropped}, audits={self.audits}, audit_top_agreements={self.audit_top_agreements}, " + \
+            f"audit_failures={self.audit_failures})"
+
+
+class RerankPolicy():
+    '''
+    Decides per query whether the LLM reranker is worth its round trip. It is skipped, keeping the retrieval order,
+    when there are fewer chunks than min_candidates (by default the reranker's top_n, which all of them would make),
+    when the best chunk leads the runner up by dominant_score_gap, or when the LLM reranker's average latency doesn't
+    fit the latency budget.
+    audit_rate of the skipped queries are reranked anyway, to measure what skipping costs (see RerankStats)
+    '''
+    min_candidates: Optional[int]
+    dominant_score_gap: Optional[float]
+    audit_rate: float
+
+    def __init__(self,
+                 min_candidates: Optional[int] = None,
+                 dominant_score_gap: Optional[float] = DEFAULT_DOMINANT_SCORE_GAP,
+                 audit_rate: float = 0.0):
+        self.min_candidates = min_candidates
+        self.dominant_score_gap = dominant_score_gap
+        self.audit_rate = audit_rate
+
+    def decide(self, choices: List[ScoredNode], stats: RerankStats, latency_budget: Optional[float] = None, top_n: Optional[int] = None) -> str:
+        '''
+        LLM_RERANK or the reason to skip it, choices are in retrieval order and top_n is the number of chunks the reranker keeps
+        '''
+        min_candidates = self.min_candidates
+        if min_candidates is None:
+            min_candidates = top_n if top_n is not None else DEFAULT_MIN_CANDIDATES
+        # a single chunk has no order to fix
+        if len(choices) < max(min_candidates, 2):
+            return SKIP_FEW_CANDIDATES
+        # MMR reorders the choices, so the runner up isn't necessarily second
+        scores = sorted([choice.score for choice in choices], reverse=True)
+        if self.dominant_score_gap is not None and scores[0] - scores[1] >= self.dominant_score_gap:
+            return SKIP_DOMINANT_SCORE
+        if latency_budget is not None and stats.llm_latency is not None and stats.llm_latency > latency_budget:
+            return SKIP_LATENCY_BUDGET
+        return LLM_RERANK
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __str__(self):
+        return f"RerankPolicy(min_candidates={self.min_candidates}, dominant_score_gap={self.dominant_score_gap}, audit_rate={self.audit_rate})"
+
+
 class Reranker():
     top_n: int
     llm_reranker_model: str
+    policy: RerankPolicy
+    stats: RerankStats
+    max_batch_docs: int
+    cache: Optional[RerankCache]
 
-    def __init__(self, top_n: int = None, llm_reranker_model: str = DEFAULT_LLM_RERANKER_MODEL):
+    def __init__(self, top_n: int = None, llm_reranker_model: str = DEFAULT_LLM_RERANKER_MODEL, policy: Optional[RerankPolicy] = None,
+                 max_batch_docs: int = DEFAULT_MAX_BATCH_DOCS, cache: Optional[RerankCache] = None):
         self.top_n = top_n
         self.llm_reranker_model = llm_reranker_model
+        self.max_batch_docs = max_batch_docs
+        # rankings of the same candidates for the same query are reused, e.g. for repeated questions and follow up turns
+        self.cache = cache
+        self.policy = policy if policy is not None else RerankPolicy()
+        self.stats = RerankStats()
+        self._audits = set()
 
     def _parse_llm_response(self, response: str) -> List[Tuple[int, int]]:
         json_response = json.loads(response)
 
         return [(int(doc['doc']), int(doc['relevance'])) for doc in json_response]
 
+    async def rerank(self, query: Query, choices: List[ScoredNode], latency_budget: Optional[float] = None) -> List[Node]:
+        '''
+        Reranks the choices (in retrieval order) with the LLM, unless the policy decides the retrieval order is good enough.
+        latency_budget is the time in seconds the caller can spend on reranking
+        '''
+        if len(choices) == 0:
+            return []
+
+        decision = self.policy.decide(choices=choices, stats=self.stats, latency_budget=latency_budget, top_n=self.top_n)
+        self.stats.decisions[decision] += 1
+        if decision == LLM_RERANK:
+            ranked, latency = await self._llm_rerank(query=query, choices=choices)
+            self._record(choices=choices, ranked=ranked, latency=latency)
+            return ranked
+        return self._skip(query=query, choices=choices, decision=decision)
+
+    async def rerank_many(self, queries: List[Query], choices: List[List[ScoredNode]], latency_budget: Optional[float] = None) -> List[List[Node]]:
+        '''
+        rerank for several queries (the subqueries of a question) at once. The queries the policy sends to the LLM share
+        batched prompts, each listing the candidates of its queries once and asking for a ranking per query
+        '''
+        rankings: List[Optional[List[Node]]] = [None] * len(queries)
+        llm_indices = []
+        for i, (query, query_choices) in enumerate(zip(queries, choices)):
+            if len(query_choices) == 0:
+                rankings[i] = []
+                continue
+            decision = self.policy.decide(choices=query_choices, stats=self.stats, latency_budget=latency_budget, top_n=self.top_n)
+            self.stats.decisions[decision] += 1
+            if decision == LLM_RERANK:
+                llm_indices.append(i)
+            else:
+                rankings[i] = self._skip(query=query, choices=query_choices, decision=decision)
+
+        # greedily packs the queries into batches of at most max_batch_docs distinct candidates that also fit the reranker
+        # model's prompt budget together. A query whose candidates alone are over the budget gets a batch of its own
+        packer = get_prompt_packer(self.llm_reranker_model)
+        batch_budget = packer.max_prompt_tokens - packer.count(generate_llm_batch_reranker_prompt(context_str="", questions_str=""))
+        doc_tokens = {}
+        for i in llm_indices:
+            for choice in choices[i]:
+                if choice.node.node_id not in doc_tokens:
+                    doc_tokens[choice.node.node_id] = packer.count(choice.to_content_str()) + packer.count("\n")
+
+        batches = []
+        batch = []
+        batch_docs = set()
+        batch_tokens = 0
+        for i in llm_indices:
+            docs = set([choice.node.node_id for choice in choices[i]])
+            question_tokens = packer.count(f"Question {len(batch) + 1}: {queries[i].q}\n")
+            tokens = question_tokens + sum([doc_tokens[doc] for doc in docs - batch_docs])
+            if len(batch) > 0 and (len(batch_docs | docs) > self.max_batch_docs or batch_tokens + tokens > batch_budget):
+                batches.append(batch)
+                batch = []
+                batch_docs = set()
+                batch_tokens = 0
+                tokens = question_tokens + sum([doc_tokens[doc] for doc in docs])
+            batch.append(i)
+            batch_docs |= docs
+            batch_tokens += tokens
+        if len(batch) > 0:
+            batches.append(batch)
+
+        batch_rankings = await asyncio.gather(*[
+            self._llm_rerank_batch(queries=[queries[i] for i in batch], choices=[choices[i] for i in batch])
+            for batch in batches])
+        for batch, (batch_ranking, latencies) in zip(batches, batch_rankings):
+            for i, ranked, latency in zip(batch, batch_ranking, latencies):
+                self._record(choices=choices[i], ranked=ranked, latency=latency)
+                rankings[i] = ranked
+        return rankings
+
+    def _record(self, choices: List[ScoredNode], ranked: List[Node], latency: Optional[float]):
+        # a cached ranking took no LLM call, its latency would drag the average the latency budget is checked against down
+        if latency is None:
+            self.stats.record_cache_hit()
+        else:
+            self.stats.record_llm_rerank(latency=latency, choices=choices, ranked=ranked)
+
+    def _skip(self, query: Query, choices: List[ScoredNode], decision: str) -> List[Node]:
+        ranked = [choice.node for choice in choices][:self.top_n]
+        if decision != SKIP_LATENCY_BUDGET and random.random() < self.policy.audit_rate:
+            # in the background, the query is answered from the skip without waiting for the audit
+            task = asyncio.create_task(self._audit(query=query, choices=choices))
+            self._audits.add(task)
+            task.add_done_callback(self._audits.discard)
+        return ranked
+
+    async def _audit(self, query: Query, choices: List[ScoredNode]):
+        try:
+            self.stats.record_audit(choices=choices, ranked=await self.llm_rerank(query=query, choices=choices))
+        except Exception:
+            # the query was already answered from the skip, a failed audit is only counted
+            self.stats.record_audit_failure()
+
+    def _with_unjudged(self, choices: List[ScoredNode], parsed_response: List[Tuple[int, int]], judged: Set[str]) -> List[Tuple[int, int]]:
+        '''
+        The LLM's picks followed by the candidates the prompt budget left out, in retrieval order. With long chunks only
+        the first few candidates fit the reranker model's prompt, the others aren't dropped for that
+        '''
+        return parsed_response + [(doc_num + 1, UNJUDGED_RELEVANCE) for doc_num, choice in enumerate(choices)
+                                  if choice.node.node_id not in judged]
+
+    def _ranked_choices(self, choices: List[ScoredNode], parsed_response: List[Tuple[int, int]]) -> List[Node]:
+        ranked_choices = []
+        for doc_num, _ in parsed_response:
+            ranked_choices.append(choices[doc_num - 1].node)
+
+        return ranked_choices[:self.top_n]
+
+    async def llm_rerank_batch(self, queries: List[Query], choices: List[List[ScoredNode]]) -> List[List[Node]]:
+        '''
+        Uses an LLM with a single prompt to rerank the top k choices of every query that isn't cached. Candidates shared by
+        several queries are sent once, a query missing from the response keeps its retrieval order
+        '''
+        return (await self._llm_rerank_batch(queries=queries, choices=choices))[0]
+
+    async def _llm_rerank_batch(self, queries: List[Query], choices: List[List[ScoredNode]]) -> Tuple[List[List[Node]], List[Optional[float]]]:
+        '''
+        llm_rerank_batch, along with the latency of the LLM call for every query, None for the queries that were cached
+        '''
+        latencies: List[Optional[float]] = [None] * len(queries)
+        parsed_responses: List[Optional[List[Tuple[int, int]]]] = [None] * len(queries)
+        if self.cache is not None:
+            parsed_responses = [self.cache.get(self.llm_reranker_model, query.q, query_choices)
+                                for query, query_choices in zip(queries, choices)]
+        uncached = [i for i, parsed_response in enumerate(parsed_responses) if parsed_response is None]
+
+        if len(uncached) > 0:
+            unique_choices = by_rank([choices[i] for i in uncached], key=lambda choice: choice.node.node_id)
+
+            questions_str = "\n".join(
+                [f"Question {index + 1}: {queries[i].q}" for index, i in enumerate(uncached)])
+            kept, _ = get_prompt_packer(self.llm_reranker_model).pack(
+                prompt="batch_rerank", fixed=generate_llm_batch_reranker_prompt(context_str="", questions_str=questions_str),
+                sources=[choice.to_content_str() for choice in unique_choices])
+            pool_choices = [unique_choices[i] for i in kept]
+            pool = {choice.node.node_id: index for index, choice in enumerate(pool_choices)}
+
+            completed_prompt = generate_llm_batch_reranker_prompt(
+                context_str="\n".join(
+                    [f"Doc {index + 1} {choice.to_content_str()}" for index, choice in enumerate(pool_choices)]),
+                questions_str=questions_str)
+
+            start = time.monotonic()
+            llm_response = (await LiteLLM.acompletion(model=self.llm_reranker_model,
+                                                      messages=[{"role": "user", "content": completed_prompt}])).choices[0].message.content
+            latency = time.monotonic() - start
+            json_response = json.loads(llm_response)
+
+            for index, i in enumerate(uncached):
+                latencies[i] = latency
+                if str(index + 1) not in json_response:
+                    continue
+                # pool numbers back to the query's own candidate numbers, so the result is the same as a single rerank's
+                doc_nums = {pool[choice.node.node_id] + 1: doc_num + 1 for doc_num, choice in enumerate(choices[i])
+                            if choice.node.node_id in pool}
+                parsed_responses[i] = self._with_unjudged(
+                    choices=choices[i],
+                    parsed_response=[(doc_nums[int(doc['doc'])], int(doc['relevance'])) for doc in json_response[str(index + 1)]
+                                     if int(doc['doc']) in doc_nums],
+                    judged=set(pool))
+                if self.cache is not None:
+                    self.cache.put(self.llm_reranker_model, queries[i].q, choices[i], parsed_responses[i])
+
+        return [[choice.node for choice in query_choices][:self.top_n] if parsed_response is None
+                else self._ranked_choices(query_choices, parsed_response)
+                for query_choices, parsed_response in zip(choices, parsed_responses)], latencies
+
     async def llm_rerank(self, query: Query, choices: List[ScoredNode]) -> List[Node]:
         '''
         Uses an LLM with a prompt to rerank the top k choices
         '''
+        return (await self._llm_rerank(query=query, choices=choices))[0]
+
+    async def _llm_rerank(self, query: Query, choices: List[ScoredNode]) -> Tuple[List[Node], Optional[float]]:
+        '''
+        llm_rerank, along with the latency of the LLM call, None if the ranking was cached
+        '''
         if len(choices) == 0:
-            return []
+            return [], None
+        if self.cache is not None:
+            parsed_response = self.cache.get(self.llm_reranker_model, query.q, choices)
+            if parsed_response is not None:
+                return self._ranked_choices(choices, parsed_response), None
+
+        # the least relevant candidates beyond the reranker model's budget are left out of the prompt
+        kept, _ = get_prompt_packer(self.llm_reranker_model).pack(
+            prompt="rerank", fixed=generate_llm_reranker_prompt(context_str="", query_str=query.q),
+            sources=[choice.to_content_str() for choice in choices])
         completed_prompt = generate_llm_reranker_prompt(
             context_str="\n".join(
-                [f"Doc {index + 1} {choice.to_content_str()}" for index, choice in enumerate(choices)]),
+                [f"Doc {index + 1} {choices[i].to_content_str()}" for index, i in enumerate(kept)]),
             query_str=query.q)
 
+        start = time.monotonic()
         llm_response = (await LiteLLM.acompletion(model=self.llm_reranker_model,
                                                   messages=[{"role": "user", "content": completed_prompt}])).choices[0].message.content
-        parsed_response = self._parse_llm_response(llm_response)
+        latency = time.monotonic() - start
+        # prompt numbers back to the numbers of all the choices
+        parsed_response = self._with_unjudged(
+            choices=choices,
+            parsed_response=[(kept[doc_num - 1] + 1, relevance) for doc_num, relevance in self._parse_llm_response(llm_response)
+                             if 1 <= doc_num <= len(kept)],
+            judged=set([choices[i].node.node_id for i in kept]))
+        if self.cache is not None:
+            self.cache.put(self.llm_reranker_model, query.q, choices, parsed_response)
 
-        ranked_choices = []
-        for doc_num, _ in parsed_response:
-            ranked_choices.append(choices[doc_num - 1].node)
-
-        return ranked_choices[:self.top_n]
+        return self._ranked_choices(choices, parsed_response), latency
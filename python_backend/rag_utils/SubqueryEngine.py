@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import AsyncGenerator, Optional, List
 
 from LiteLLM import LiteLLM
 from Message import Message
@@ -52,3 +52,22 @@ class SubQueryEngine():
             return []
         # otherwise, split the response by newlines
         return llm_response.split('\n')
+
+    async def stream_subqueries(self, query: Query, message_history: List[Message] = None) -> AsyncGenerator[str, None]:
+        '''
+        generate_subqueries, yielding every subquery as soon as its line of the completion is complete
+        '''
+        completed_prompt = generate_subquery_prompt(
+            query=query, limit=self.limit)
+        response = await LiteLLM.acompletion(model=self.subquery_model,
+                                             messages=[{"role": "user", "content": completed_prompt}], stream=True)
+        buffer = ""
+        async for chunk in response:
+            buffer += chunk.choices[0].delta.content or ""
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                # "None" means no subqueries are needed
+                if len(line) != 0 and line != "None":
+                    yield line
+        if len(buffer) != 0 and buffer != "None":
+            yield buffer
@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from Database import Database, FULL_PRECISION, HALF_PRECISION, BINARY_PRECISION, PRECISIONS, compact_embedding_sql
+from Query import Query
+
+HNSW = "hnsw"
+IVFFLAT = "ivfflat"
+INDEX_METHODS = [HNSW, IVFFLAT]
+
+DEFAULT_INDEX_METHOD = HNSW
+# get_top_k orders by cosine distance (<=>) on full/half precision vectors and hamming distance (<~>) on binary ones
+OPERATOR_CLASSES = {
+    FULL_PRECISION: "vector_cosine_ops",
+    HALF_PRECISION: "halfvec_cosine_ops",
+    BINARY_PRECISION: "bit_hamming_ops",
+}
+DEFAULT_HNSW_M = 16
+DEFAULT_HNSW_EF_CONSTRUCTION = 64
+DEFAULT_MAINTENANCE_WORK_MEM = "1GB"
+# Postgres truncates longer identifiers, so the indexes of two precisions on a partition could end up with the same name
+MAX_IDENTIFIER_BYTES = 63
+IDENTIFIER_HASH_LENGTH = 8
+# halfvec and binary_quantize, which half and binary precision indexes and searches use, were added in pgvector 0.7.0
+MIN_COMPACT_PRECISION_PGVECTOR_VERSION = (0, 7, 0)
+
+
+def postgres_identifier(name: str) -> str:
+    '''
+    The name if it fits Postgres' identifier limit, otherwise a prefix of it followed by a short hash of the whole name
+    '''
+    if len(name.encode()) <= MAX_IDENTIFIER_BYTES:
+        return name
+    digest = hashlib.sha1(name.encode()).hexdigest()[:IDENTIFIER_HASH_LENGTH]
+    prefix = name.encode()[:MAX_IDENTIFIER_BYTES - IDENTIFIER_HASH_LENGTH - 1].decode(errors='ignore')
+    return prefix + "_" + digest
+
+
+def parse_extension_version(extversion: str) -> Tuple[int, ...]:
+    '''
+    "0.7.0" -> (0, 7, 0). A suffix on a part (e.g. "0.8.0-dev") is ignored
+    '''
+    version = []
+    for part in extversion.split("."):
+        digits = ""
+        for char in part:
+            if not char.isdigit():
+                break
+            digits += char
+        version.append(int(digits) if digits else 0)
+    return tuple(version)
+
+
+def default_ivfflat_lists(row_count: int) -> int:
+    '''
+    pgvector's recommendation: rows / 1000 up to 1M rows, sqrt(rows) above that
+    '''
+    if row_count <= 1_000_000:
+        return max(1, row_count // 1000)
+    return int(math.sqrt(row_count))
+
+
+class VectorIndexManager():
+    '''
+    Creates, rebuilds and inspects the ANN indexes on the embedding column of a vector store table
+    '''
+    db: Database
+    build_times: Dict[str, float]
+
+    def __init__(self, db: Database):
+        self.db = db
+        # index name -> seconds the last create/rebuild took in this process
+        self.build_times = {}
+
+    def index_name(self, method: str, precision: str = FULL_PRECISION, table: Optional[str] = None) -> str:
+        table = table or self.db.vector_store_table
+        if precision == FULL_PRECISION:
+            return postgres_identifier(f"{table}_embedding_{method}_idx")
+        return postgres_identifier(f"{table}_embedding_{precision}_{method}_idx")
+
+    async def check_precision_support(self, precision: str):
+        '''
+        Raises if the installed pgvector extension is too old for indexes/searches at the precision
+        '''
+        if precision == FULL_PRECISION:
+            return
+        async with self.db.acquire() as conn:
+            extversion = await conn.fetchval("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        if extversion is None:
+            raise Exception("The pgvector extension is not installed in the database")
+        if parse_extension_version(extversion) < MIN_COMPACT_PRECISION_PGVECTOR_VERSION:
+            required = ".".join([str(part) for part in MIN_COMPACT_PRECISION_PGVECTOR_VERSION])
+            raise Exception(
+                f"{precision} precision needs pgvector {required} or newer (halfvec, binary_quantize), the database has {extversion}. " +
+                "Upgrade the extension with ALTER EXTENSION vector UPDATE or use full precision")
+
+    async def _build(self, statements: List[Tuple[str, str]], maintenance_work_mem: str) -> float:
+        '''
+        Runs (index name, sql) statements in order on one connection and returns the total build time in seconds
+        '''
+        total_time = 0.0
+        async with self.db.acquire() as conn:
+            # builds are much faster when the graph/lists fit in memory. reset when the connection goes back to the pool
+            await conn.execute("SELECT set_config('maintenance_work_mem', $1, false)", maintenance_work_mem)
+            for index_name, sql_query in statements:
+                start = time.perf_counter()
+                await conn.execute(sql_query)
+                build_time = time.perf_counter() - start
+                self.build_times[index_name] = build_time
+                total_time += build_time
+
+        return total_time
+
+    async def _partition_tree(self) -> List[Dict[str, Any]]:
+        '''
+        The table and all of its partitions, parents first. A table that isn't partitioned is its own single leaf
+        '''
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT relid::text AS name, parentrelid::text AS parent, isleaf AS is_leaf
+                FROM pg_partition_tree($1::regclass)
+                ORDER BY level
+            """, self.db.vector_store_table)
+        return [dict(row) for row in rows]
+
+    async def create_index(self,
+                           method: str = DEFAULT_INDEX_METHOD,
+                           precision: str = FULL_PRECISION,
+                           m: int = DEFAULT_HNSW_M,
+                           ef_construction: int = DEFAULT_HNSW_EF_CONSTRUCTION,
+                           lists: Optional[int] = None,
+                           concurrently: bool = True,
+                           maintenance_work_mem: str = DEFAULT_MAINTENANCE_WORK_MEM) -> float:
+        '''
+        Creates an HNSW or IVFFlat index on the embedding column and returns the build time in seconds.
+        With a half or binary precision the index is built on the compact expression of the embedding, which is what
+        Database searches with that precision order by.
+        Half and binary precision need pgvector 0.7.0 or newer.
+        On a partitioned table every partition gets its own index, attached to an index on the parent so that
+        partitions created later get one too.
+        IVFFlat indexes should be created after the table is loaded, since the lists are trained on the existing rows
+        '''
+        if method not in INDEX_METHODS:
+            raise ValueError(
+                f"Invalid index method {method}, expected one of {INDEX_METHODS}")
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Invalid precision {precision}, expected one of {PRECISIONS}")
+        await self.check_precision_support(precision)
+
+        if method == HNSW:
+            with_clause = f"(m = {int(m)}, ef_construction = {int(ef_construction)})"
+        else:
+            if lists is None:
+                async with self.db.acquire() as conn:
+                    row_count = await conn.fetchval("SELECT count(*) FROM " + self.db.vector_store_table)
+                lists = default_ivfflat_lists(row_count)
+            with_clause = f"(lists = {int(lists)})"
+
+        indexed_expression = "embedding" if precision == FULL_PRECISION else \
+            "(" + compact_embedding_sql("embedding", precision) + ")"
+        index_definition = " USING " + method + \
+            " (" + indexed_expression + " " + OPERATOR_CLASSES[precision] + ") WITH " + with_clause
+
+        tree = await self._partition_tree()
+        if len(tree) == 1 or not concurrently:
+            # an index on a partitioned parent is created on every partition, but only without CONCURRENTLY
+            index_name = self.index_name(method, precision)
+            sql_query = "CREATE INDEX " + ("CONCURRENTLY " if concurrently else "") + "IF NOT EXISTS " + index_name + \
+                " ON " + self.db.vector_store_table + index_definition
+            return await self._build([(index_name, sql_query)], maintenance_work_mem)
+
+        # postgres' recipe for building a partitioned index without blocking writes: an (invalid) index on only the
+        # parents, indexes built concurrently on the leaves, then attached bottom up, which makes the parents valid
+        statements = []
+        for table in tree:
+            index_name = self.index_name(method, precision, table['name'])
+            if table['is_leaf']:
+                statements.append((index_name, "CREATE INDEX CONCURRENTLY IF NOT EXISTS " + index_name +
+                                   " ON " + table['name'] + index_definition))
+            else:
+                statements.append((index_name, "CREATE INDEX IF NOT EXISTS " + index_name +
+                                   " ON ONLY " + table['name'] + index_definition))
+        build_time = await self._build(statements, maintenance_work_mem)
+
+        async with self.db.acquire() as conn:
+            for table in reversed(tree[1:]):
+                index_name = self.index_name(method, precision, table['name'])
+                attached = await conn.fetchval("SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = $1::regclass)",
+                                               index_name)
+                if not attached:
+                    await conn.execute("ALTER INDEX " + self.index_name(method, precision, table['parent']) +
+                                       " ATTACH PARTITION " + index_name)
+
+        self.build_times[self.index_name(method, precision)] = build_time
+        return build_time
+
+    async def rebuild_index(self,
+                            method: str = DEFAULT_INDEX_METHOD,
+                            precision: str = FULL_PRECISION,
+                            concurrently: bool = True,
+                            maintenance_work_mem: str = DEFAULT_MAINTENANCE_WORK_MEM) -> float:
+        '''
+        Rebuilds an existing index (e.g. after a large re-sync or to retrain IVFFlat lists) and returns the build time in seconds.
+        On a partitioned table this rebuilds the index of every partition (needs postgres 14+)
+        '''
+        await self.check_precision_support(precision)
+        index_name = self.index_name(method, precision)
+        sql_query = "REINDEX INDEX " + \
+            ("CONCURRENTLY " if concurrently else "") + index_name
+
+        return await self._build([(index_name, sql_query)], maintenance_work_mem)
+
+    async def drop_index(self, method: str = DEFAULT_INDEX_METHOD, precision: str = FULL_PRECISION, concurrently: bool = True):
+        index_name = self.index_name(method, precision)
+        # dropping the index of a partitioned table drops the partitions' indexes with it, but can't be done concurrently
+        if len(await self._partition_tree()) > 1:
+            concurrently = False
+        async with self.db.acquire() as conn:
+            await conn.execute("DROP INDEX " + ("CONCURRENTLY " if concurrently else "") +
+                               "IF EXISTS " + index_name)
+        self.build_times.pop(index_name, None)
+
+    async def inspect(self) -> List[Dict[str, Any]]:
+        '''
+        Lists the ANN indexes on the table and its partitions with their size and, if built by this process, their build time
+        '''
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT idx.relname AS name, i.indrelid::regclass::text AS table_name, am.amname AS method,
+                    pg_get_indexdef(idx.oid) AS definition,
+                    pg_relation_size(idx.oid) AS size_bytes, pg_size_pretty(pg_relation_size(idx.oid)) AS size,
+                    i.indisvalid AS is_valid
+                FROM pg_index i
+                JOIN pg_class idx ON idx.oid = i.indexrelid
+                JOIN pg_am am ON am.oid = idx.relam
+                WHERE i.indrelid IN (SELECT relid FROM pg_partition_tree($1::regclass)) AND am.amname = ANY($2::text[])
+                ORDER BY idx.relname
+            """, self.db.vector_store_table, INDEX_METHODS)
+
+        return [{
+            "name": row['name'],
+            "table": row['table_name'],
+            "method": row['method'],
+            "definition": row['definition'],
+            # 0 for the index of a partitioned parent, the data is in its partitions' indexes
+            "size_bytes": row['size_bytes'],
+            "size": row['size'],
+            # an invalid index is left behind by a failed concurrent build and should be rebuilt
+            "is_valid": row['is_valid'],
+            "build_time": self.build_times.get(row['name']),
+        } for row in rows]
+
+    async def measure_recall(self, queries: List[Query], k: int, precision: str, oversample: Optional[int] = None) -> float:
+        '''
+        Mean recall@k of compact precision searches (with re-scoring) against exact full precision searches over the sample queries
+        '''
+        if len(queries) == 0:
+            raise ValueError("Need at least one query to measure recall")
+        await self.check_precision_support(precision)
+
+        exact_results = await self.db.get_top_k_many(queries=queries, k=k, recall="exact", precision=FULL_PRECISION)
+        compact_results = await self.db.get_top_k_many(queries=queries, k=k, precision=precision, oversample=oversample)
+
+        recalls = []
+        for exact, compact in zip(exact_results, compact_results):
+            if len(exact) == 0:
+                continue
+            exact_ids = set([scored_node.node.node_id for scored_node in exact])
+            compact_ids = set([scored_node.node.node_id for scored_node in compact])
+            recalls.append(len(exact_ids & compact_ids) / len(exact_ids))
+
+        return sum(recalls) / len(recalls) if len(recalls) > 0 else 1.0
+
+
+if __name__ == "__main__":
+    async def main():
+        db = Database("data_v1")
+        index_manager = VectorIndexManager(db)
+
+        build_time = await index_manager.create_index(method=HNSW)
+        print(f"built in {build_time:.1f}s")
+        print(await index_manager.inspect())
+
+        await db.kill()
+
+    asyncio.run(main())
@@ -2,6 +2,7 @@ import asyncio
 
 from Database import Database
 from Reranker import Reranker
+from RerankCache import RerankCache
 from SubqueryEngine import SubQueryEngine
 from Query import Query
 from DataEmitter import DataEmitter
@@ -24,12 +25,13 @@ async def main():
     ########################################
 
     db = Database("data_v1")
-    reranker = Reranker(top_n=5)
+    reranker = Reranker(top_n=5, cache=RerankCache())
     subquery_engine = SubQueryEngine(limit=3)
     data_emitter = DataEmitter()
     data_emitter.on(lambda x: print(x))
     conversation_engine = ConversationEngine(
         db=db, reranker=reranker, subquery_engine=subquery_engine)
+    await conversation_engine.listen()
 
     q = "it infrastructure changes and feedback"
     user_message = UserMessage(message=q)
@@ -100,4 +102,6 @@ The plan reflects a comprehensive approach, incorporating recent IT infrastructu
     print("answer")
     print(res)
 
+    await db.kill()
+
 asyncio.run(main())
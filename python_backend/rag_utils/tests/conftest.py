@@ -0,0 +1,5 @@
+import os
+import sys
+
+# rag_utils modules import each other by file name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+import asyncio
+
+import MemoryMappedDatabase as memory_mapped_module
+from ConversationEngine import ConversationEngine
+from Database import CHUNKS_CHANGED_CHANNEL
+from MemoryMappedDatabase import MemoryMappedDatabase
+from Node import Node, ScoredNode
+from RerankCache import RerankCache
+from Reranker import Reranker
+
+
+class NotifyingDatabase():
+    '''
+    Hands the notifications sent with notify to the callbacks listening on their channel
+    '''
+
+    def __init__(self):
+        self.vector_store_table = "data_v1"
+        self.callbacks = {}
+
+    async def listen(self, channel, callback):
+        self.callbacks.setdefault(channel, []).append(callback)
+
+    def notify(self, channel, payload):
+        for callback in self.callbacks.get(channel, []):
+            callback(payload)
+
+
+def test_listen_drops_cached_rankings_of_rewritten_documents():
+    db = NotifyingDatabase()
+    reranker = Reranker(top_n=5, cache=RerankCache())
+    choices = [ScoredNode(node=Node(text="a", metadata={'doc_id': "doc-1"}, node_id="a"), score=0.9)]
+    reranker.cache.put(reranker.llm_reranker_model, "question", choices, [(1, 9)])
+
+    asyncio.run(ConversationEngine(db=db, reranker=reranker, subquery_engine=None).listen())
+    db.notify(CHUNKS_CHANGED_CHANNEL, {'user_id': "user-1", 'doc_ids': ["doc-1"]})
+
+    assert reranker.cache.get(reranker.llm_reranker_model, "question", choices) is None
+
+
+def test_listen_refreshes_the_tenants_memory_mapped_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory_mapped_module, "REFRESH_DEBOUNCE_SECONDS", 0)
+    db = NotifyingDatabase()
+    snapshot_db = MemoryMappedDatabase(db, user_id="user-1", snapshot_dir=str(tmp_path))
+    refreshes = []
+
+    async def refresh(full=False):
+        refreshes.append(full)
+        return True
+
+    snapshot_db.refresh = refresh
+
+    async def run():
+        await ConversationEngine(db=snapshot_db, reranker=Reranker(top_n=5, cache=RerankCache()), subquery_engine=None).listen()
+        db.notify(CHUNKS_CHANGED_CHANNEL, {'user_id': "user-2", 'doc_ids': ["doc-2"]})
+        assert snapshot_db._refresh_task is None
+        db.notify(CHUNKS_CHANGED_CHANNEL, {'user_id': "user-1", 'doc_ids': ["doc-1"]})
+        await snapshot_db._refresh_task
+
+    asyncio.run(run())
+
+    assert refreshes == [False]
+    # the rerank cache listens on the database the snapshot is refreshed from
+    assert len(db.callbacks[CHUNKS_CHANGED_CHANNEL]) == 2
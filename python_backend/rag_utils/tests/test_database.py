@@ -0,0 +1,68 @@
+import pytest
+
+from AccessScope import AccessScope
+from Database import Database, BINARY_PRECISION, FULL_PRECISION, HALF_PRECISION, HYBRID_SEARCH_MODE, VECTOR_SEARCH_MODE
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "postgresql://localhost/test")
+    return Database(vector_store_table="data_v1")
+
+
+def test_no_filter_conditions_without_scope_or_doc_filter(db):
+    params = []
+    assert db._filter_conditions(params) == []
+    assert params == []
+
+
+def test_scope_conditions_match_the_tenant_and_its_principals(db):
+    params = ["embedding"]
+    conditions = db._filter_conditions(params, doc_filter=["doc-1", "doc-2"],
+                                       scope=AccessScope(user_id="user-1", identities=["Ann@Example.com"], groups=["Eng"]))
+
+    assert conditions == ["chunk.metadata_ ->> 'user_id' = $2",
+                          "chunk.acl && $3::text[]",
+                          "chunk.metadata_ ->> 'id' = ANY($4::text[])"]
+    assert params == ["embedding", "user-1", ["public", "domain", "user:ann@example.com", "group:eng"], ["doc-1", "doc-2"]]
+
+
+def test_vector_top_k_orders_by_cosine_distance_in_the_index(db):
+    sql_query = db._top_k_sql(embedding="$1", text=None, k="$2", conditions=["chunk.acl && $3::text[]"],
+                              mode=VECTOR_SEARCH_MODE, precision=FULL_PRECISION, oversample=None)
+
+    assert sql_query == "SELECT chunk.node_id, chunk.text, chunk.metadata_, 1 - (chunk.embedding <=> $1) AS cosine_similarity," + \
+        " 1 - (chunk.embedding <=> $1) AS search_score FROM data_v1 chunk WHERE chunk.acl && $3::text[]" + \
+        " ORDER BY chunk.embedding <=> $1 LIMIT $2"
+
+
+def test_compact_top_k_oversamples_then_rescores_at_full_precision(db):
+    sql_query = db._top_k_sql(embedding="$1", text=None, k="$2", conditions=[],
+                              mode=VECTOR_SEARCH_MODE, precision=HALF_PRECISION, oversample=None, with_embeddings=True)
+
+    assert "SELECT chunk.node_id, chunk.text, chunk.metadata_, chunk.embedding, 1 - (chunk.embedding <=> $1) AS cosine_similarity" in sql_query
+    assert "ORDER BY (chunk.embedding)::halfvec(1536) <=> ($1)::halfvec(1536) LIMIT ($2) * 2) candidates" in sql_query
+    assert sql_query.endswith("ORDER BY candidates.cosine_similarity DESC LIMIT $2")
+
+    binary_sql = db._top_k_sql(embedding="$1", text=None, k="$2", conditions=[],
+                               mode=VECTOR_SEARCH_MODE, precision=BINARY_PRECISION, oversample=4)
+    assert "binary_quantize(chunk.embedding)::bit(1536) <~> binary_quantize($1)::bit(1536) LIMIT ($2) * 4" in binary_sql
+
+
+def test_hybrid_top_k_filters_both_rankings(db):
+    sql_query = db._top_k_sql(embedding="$1", text="$2", k="$3", conditions=["chunk.acl && $4::text[]"],
+                              mode=HYBRID_SEARCH_MODE, precision=FULL_PRECISION, oversample=None)
+
+    text_query = "websearch_to_tsquery('english', $2)"
+    assert sql_query.count("WHERE chunk.acl && $4::text[]") == 2
+    assert "WHERE chunk.acl && $4::text[] AND chunk.text_search_tsv @@ " + text_query in sql_query
+    assert "LIMIT ($3) * 4) ranked" in sql_query
+    assert "FULL OUTER JOIN" in sql_query
+    assert sql_query.endswith("ORDER BY fused.rrf_score DESC LIMIT $3")
+
+
+def test_top_k_rejects_unknown_modes_and_precisions(db):
+    with pytest.raises(ValueError):
+        db._top_k_sql(embedding="$1", text=None, k="$2", conditions=[], mode="fuzzy", precision=FULL_PRECISION, oversample=None)
+    with pytest.raises(ValueError):
+        db._top_k_sql(embedding="$1", text=None, k="$2", conditions=[], mode=VECTOR_SEARCH_MODE, precision="int8", oversample=None)
@@ -0,0 +1,71 @@
+import asyncio
+
+import numpy as np
+
+from EmbeddingCache import EmbeddingCache
+
+
+class BlockingEmbeddingCache(EmbeddingCache):
+    '''
+    Fetches without a database: every fetch waits until release is set
+    '''
+
+    def __init__(self):
+        super().__init__(db=None)
+        self.release = asyncio.Event()
+        self.fetches = 0
+
+    async def _fetch(self, model, keys, texts):
+        self.fetches += 1
+        await self.release.wait()
+        return [np.full(3, len(text), dtype=np.float32) for text in texts]
+
+
+def test_concurrent_requests_share_one_fetch():
+    async def run():
+        cache = BlockingEmbeddingCache()
+        first = asyncio.create_task(cache.embed("model", "hello"))
+        second = asyncio.create_task(cache.embed("model", "Hello "))
+        await asyncio.sleep(0)
+        cache.release.set()
+        return cache, await first, await second
+
+    cache, first, second = asyncio.run(run())
+    assert cache.fetches == 1
+    assert np.array_equal(first, second)
+
+
+def test_waiter_survives_cancelled_owner():
+    async def run():
+        cache = BlockingEmbeddingCache()
+        owner = asyncio.create_task(cache.embed("model", "hello"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.embed("model", "hello"))
+        await asyncio.sleep(0)
+
+        owner.cancel()
+        await asyncio.sleep(0)
+        cache.release.set()
+        return owner, await asyncio.wait_for(waiter, timeout=1)
+
+    owner, embedding = asyncio.run(run())
+    assert owner.cancelled()
+    assert np.array_equal(embedding, np.full(3, 5, dtype=np.float32))
+
+
+def test_cancelled_waiter_does_not_cancel_owner():
+    async def run():
+        cache = BlockingEmbeddingCache()
+        owner = asyncio.create_task(cache.embed("model", "hello"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.embed("model", "hello"))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        await asyncio.sleep(0)
+        cache.release.set()
+        return waiter, await asyncio.wait_for(owner, timeout=1)
+
+    waiter, embedding = asyncio.run(run())
+    assert waiter.cancelled()
+    assert np.array_equal(embedding, np.full(3, 5, dtype=np.float32))
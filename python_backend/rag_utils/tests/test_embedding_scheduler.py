@@ -0,0 +1,66 @@
+import asyncio
+import types
+
+import pytest
+
+import EmbeddingScheduler as scheduler_module
+from EmbeddingScheduler import EmbeddingScheduler, _is_retryable
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize("error", [StatusError(429), StatusError(500), StatusError(503),
+                                   asyncio.TimeoutError(), ConnectionResetError()])
+def test_transient_errors_are_retried(error):
+    assert _is_retryable(error)
+
+
+@pytest.mark.parametrize("error", [StatusError(400), StatusError(401), ValueError("bad input"), KeyError("data")])
+def test_other_errors_are_not_retried(error):
+    assert not _is_retryable(error)
+
+
+class FlakyEmbeddings():
+    '''
+    Raises the queued errors in order, then embeds
+    '''
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self, model, input, **kwargs):
+        self.calls += 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return types.SimpleNamespace(data=[types.SimpleNamespace(embedding=[float(len(text))]) for text in input])
+
+
+def embed_with(monkeypatch, embeddings):
+    async def no_backoff(seconds):
+        pass
+
+    monkeypatch.setattr(scheduler_module.LiteLLM, "aembedding", embeddings, raising=False)
+    monkeypatch.setattr(scheduler_module.asyncio, "sleep", no_backoff)
+    scheduler = EmbeddingScheduler(model="openai:embeddings", max_retries=2)
+    return scheduler, asyncio.run(scheduler._embed_batch(["ab", "c"], token_count=2))
+
+
+def test_rate_limited_batch_is_retried(monkeypatch):
+    embeddings = FlakyEmbeddings([StatusError(429), ConnectionResetError()])
+    scheduler, embedded = embed_with(monkeypatch, embeddings)
+
+    assert embedded == [[2.0], [1.0]]
+    assert embeddings.calls == 3
+    assert scheduler.retries == 2
+
+
+def test_bad_request_fails_without_retrying(monkeypatch):
+    embeddings = FlakyEmbeddings([StatusError(400)])
+    with pytest.raises(StatusError):
+        embed_with(monkeypatch, embeddings)
+    assert embeddings.calls == 1
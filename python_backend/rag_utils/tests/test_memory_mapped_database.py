@@ -0,0 +1,99 @@
+import asyncio
+import json
+import os
+import types
+
+import numpy as np
+import pytest
+
+from AccessScope import AccessScope
+from MemoryMappedDatabase import MemoryMappedDatabase, MANIFEST_FILE, SNAPSHOT_VERSION
+from Query import Query
+
+
+def write_segment(path, name, rows):
+    '''
+    Writes a segment the way MemoryMappedDatabase._write_segment does, rows are dicts of id, user_id, embedding and acl
+    '''
+    prefix = os.path.join(path, name)
+    embeddings = np.array([row['embedding'] for row in rows], dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.save(prefix + ".npy", embeddings)
+    np.save(prefix + ".ids.npy", np.array([row['id'] for row in rows], dtype=np.int64))
+    np.save(prefix + ".docs.npy", np.array(["doc-" + str(row['id']) for row in rows], dtype=str))
+    np.save(prefix + ".users.npy", np.array([row['user_id'] for row in rows], dtype=str))
+
+    principals = {}
+    indptr = [0]
+    indices = []
+    offsets = [0]
+    with open(prefix + ".jsonl", "wb") as rows_file:
+        for row in rows:
+            for principal in row['acl']:
+                indices.append(principals.setdefault(principal, len(principals)))
+            indptr.append(len(indices))
+            line = json.dumps({"node_id": str(row['id']), "text": "chunk " + str(row['id']),
+                               "metadata": {"user_id": row['user_id']}}).encode() + b"\n"
+            rows_file.write(line)
+            offsets.append(offsets[-1] + len(line))
+    np.save(prefix + ".offsets.npy", np.array(offsets, dtype=np.int64))
+    np.save(prefix + ".acl.npy", np.array(list(principals.keys()), dtype=str))
+    np.save(prefix + ".acl_indptr.npy", np.array(indptr, dtype=np.int64))
+    np.save(prefix + ".acl_indices.npy", np.array(indices, dtype=np.int64))
+
+
+def snapshot_db(tmp_path, user_id, rows):
+    db = MemoryMappedDatabase(types.SimpleNamespace(vector_store_table="data_v1"), user_id=user_id, snapshot_dir=str(tmp_path))
+    os.makedirs(db.snapshot_path)
+    write_segment(db.snapshot_path, "segment-1", rows)
+    with open(os.path.join(db.snapshot_path, MANIFEST_FILE), "w") as manifest_file:
+        json.dump({"version": SNAPSHOT_VERSION, "segments": ["segment-1"], "deleted_ids": []}, manifest_file)
+    return db
+
+
+ROWS = [
+    {"id": 1, "user_id": "alice", "embedding": [1, 0, 0], "acl": ["public"]},
+    {"id": 2, "user_id": "bob", "embedding": [1, 0.1, 0], "acl": ["public"]},
+    {"id": 3, "user_id": "bob", "embedding": [1, 0, 0.1], "acl": ["domain"]},
+    {"id": 4, "user_id": "alice", "embedding": [0, 1, 0], "acl": ["user:alice@example.com"]},
+    {"id": 5, "user_id": "alice", "embedding": [0, 0, 1], "acl": ["user:carol@example.com"]},
+]
+
+
+def query():
+    return Query(q="query", embedding=[1, 0.5, 0.5])
+
+
+def test_scope_only_reads_its_own_tenant(tmp_path):
+    db = snapshot_db(tmp_path, None, ROWS)
+    scope = AccessScope(user_id="alice", identities=["Alice@example.com"])
+
+    results = asyncio.run(db.get_top_k(query=query(), k=5, scope=scope))
+
+    assert sorted([result.node.node_id for result in results]) == ["1", "4"]
+
+
+def test_without_scope_reads_every_row(tmp_path):
+    db = snapshot_db(tmp_path, None, ROWS)
+
+    results = asyncio.run(db.get_top_k(query=query(), k=5))
+
+    assert len(results) == 5
+
+
+def test_scope_of_another_tenant_is_rejected(tmp_path):
+    db = snapshot_db(tmp_path, "alice", [row for row in ROWS if row['user_id'] == "alice"])
+    scope = AccessScope(user_id="bob", identities=["bob@example.com"])
+
+    with pytest.raises(ValueError):
+        asyncio.run(db.get_top_k(query=query(), k=5, scope=scope))
+
+
+def test_deleted_rows_are_masked(tmp_path):
+    db = snapshot_db(tmp_path, None, ROWS)
+    with open(os.path.join(db.snapshot_path, MANIFEST_FILE), "w") as manifest_file:
+        json.dump({"version": SNAPSHOT_VERSION, "segments": ["segment-1"], "deleted_ids": [1, 2]}, manifest_file)
+
+    results = asyncio.run(db.get_top_k(query=query(), k=5))
+
+    assert sorted([result.node.node_id for result in results]) == ["3", "4", "5"]
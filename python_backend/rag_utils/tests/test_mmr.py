@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from MMR import mmr_select
+from Node import Node, ScoredNode
+from Query import Query
+
+
+def candidate(node_id, embedding, score=0.9):
+    return ScoredNode(node=Node(text=node_id, metadata={}, node_id=node_id, embedding=embedding), score=score)
+
+
+def test_near_duplicate_gives_way_to_a_distinct_candidate():
+    query = Query("question", embedding=np.array([1.0, 0.0, 0.0], dtype=np.float32))
+    candidates = [candidate("a", [1.0, 0.1, 0.0]),
+                  candidate("a copy", [1.0, 0.11, 0.0]),
+                  candidate("b", [0.7, 0.0, 0.7])]
+
+    picked = mmr_select(query=query, candidates=candidates, k=2, lambda_mult=0.5)
+
+    assert [choice.node.node_id for choice in picked] == ["a", "b"]
+
+
+def test_lambda_one_is_plain_top_k_by_similarity():
+    query = Query("question", embedding=np.array([1.0, 0.0], dtype=np.float32))
+    candidates = [candidate("far", [0.0, 1.0]), candidate("near", [1.0, 0.0]), candidate("middle", [1.0, 1.0])]
+
+    picked = mmr_select(query=query, candidates=candidates, k=2, lambda_mult=1.0)
+
+    assert [choice.node.node_id for choice in picked] == ["near", "middle"]
+
+
+def test_query_and_candidate_embeddings_are_not_modified():
+    query = Query("question", embedding=np.array([3.0, 4.0], dtype=np.float32))
+    candidate_embedding = np.array([0.0, 2.0], dtype=np.float32)
+    candidates = [candidate("a", candidate_embedding), candidate("b", [2.0, 0.0]), candidate("c", [1.0, 1.0])]
+
+    mmr_select(query=query, candidates=candidates, k=2)
+
+    assert np.array_equal(query.embedding, [3.0, 4.0])
+    assert np.array_equal(candidate_embedding, [0.0, 2.0])
+
+
+def test_few_candidates_are_returned_as_is():
+    candidates = [candidate("a", None)]
+    assert mmr_select(query=Query("question", embedding=[1.0]), candidates=candidates, k=5) == candidates
+
+
+def test_missing_embeddings_are_rejected():
+    candidates = [candidate("a", [1.0]), candidate("b", None)]
+    with pytest.raises(ValueError):
+        mmr_select(query=Query("question", embedding=[1.0]), candidates=candidates, k=1)
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import types
+
+import Reranker as reranker_module
+from Node import Node, ScoredNode
+from Query import Query
+from RerankCache import RerankCache
+from Reranker import Reranker, RerankPolicy
+
+
+def scored(*names):
+    return [ScoredNode(node=Node(text=name, metadata={}, node_id=name), score=0.9) for name in names]
+
+
+def completion(content):
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))])
+
+
+class FakeCompletions():
+    '''
+    Replies with the queued responses in order after delay seconds, keeping the prompts it was sent
+    '''
+
+    def __init__(self, responses, delay: float = 0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.prompts = []
+
+    async def __call__(self, model, messages, **kwargs):
+        self.prompts.append(messages[0]['content'])
+        await asyncio.sleep(self.delay)
+        return completion(self.responses.pop(0))
+
+
+def test_batch_doc_numbers_map_back_to_each_querys_candidates(monkeypatch):
+    # the pool is in rank order, a=1, c=2, b=3, d=4. The second query's own numbering is c=1, a=2, d=3
+    completions = FakeCompletions([json.dumps({
+        "1": [{"doc": 3, "relevance": 9}, {"doc": 1, "relevance": 5}],
+        "2": [{"doc": 4, "relevance": 8}, {"doc": 1, "relevance": 6}, {"doc": 2, "relevance": 2}],
+    })])
+    monkeypatch.setattr(reranker_module.LiteLLM, "acompletion", completions, raising=False)
+    reranker = Reranker(top_n=5, cache=RerankCache())
+
+    first, second = asyncio.run(reranker.llm_rerank_batch(
+        queries=[Query("first", embedding=[1.0]), Query("second", embedding=[1.0])],
+        choices=[scored("a", "b"), scored("c", "a", "d")]))
+
+    assert [node.node_id for node in first] == ["b", "a"]
+    assert [node.node_id for node in second] == ["d", "a", "c"]
+    # shared candidates are sent once
+    assert completions.prompts[0].count("Doc ") == 4
+    # cached in each query's own numbering, the same as a single rerank would
+    assert reranker.cache.get(reranker.llm_reranker_model, "second", scored("c", "a", "d")) == [(3, 8), (2, 6), (1, 2)]
+
+
+def test_batch_query_missing_from_response_keeps_retrieval_order(monkeypatch):
+    monkeypatch.setattr(reranker_module.LiteLLM, "acompletion", FakeCompletions([json.dumps({"1": [{"doc": 3, "relevance": 9}]})]), raising=False)
+    reranker = Reranker(top_n=5)
+
+    first, second = asyncio.run(reranker.llm_rerank_batch(
+        queries=[Query("first", embedding=[1.0]), Query("second", embedding=[1.0])],
+        choices=[scored("a", "b"), scored("c", "d")]))
+
+    assert [node.node_id for node in first] == ["b"]
+    assert [node.node_id for node in second] == ["c", "d"]
+
+
+def test_cached_rankings_are_not_recorded_as_llm_reranks(monkeypatch):
+    completions = FakeCompletions([json.dumps([{"doc": 2, "relevance": 9}, {"doc": 1, "relevance": 4}])], delay=0.05)
+    monkeypatch.setattr(reranker_module.LiteLLM, "acompletion", completions, raising=False)
+    reranker = Reranker(top_n=5, cache=RerankCache(), policy=RerankPolicy(min_candidates=1, dominant_score_gap=None))
+    query = Query("question", embedding=[1.0])
+
+    async def run():
+        await reranker.rerank(query=query, choices=scored("a", "b"))
+        return await reranker.rerank_many(queries=[query], choices=[scored("a", "b")])
+
+    rankings = asyncio.run(run())
+
+    assert [node.node_id for node in rankings[0]] == ["b", "a"]
+    assert len(completions.prompts) == 1
+    assert reranker.stats.decisions["llm"] == 2
+    assert reranker.stats.cache_hits == 1
+    # the cache hit's near zero latency isn't averaged in
+    assert reranker.stats.llm_latency >= 0.05
+
+
+def test_policy_skips_fewer_candidates_than_top_n():
+    policy = RerankPolicy(dominant_score_gap=None)
+    stats = reranker_module.RerankStats()
+
+    assert policy.decide(choices=scored("a", "b", "c", "d"), stats=stats, top_n=5) == reranker_module.SKIP_FEW_CANDIDATES
+    assert policy.decide(choices=scored("a", "b", "c", "d", "e"), stats=stats, top_n=5) == reranker_module.LLM_RERANK
+    # without a top_n every chunk is kept, the default minimum applies
+    assert policy.decide(choices=scored("a", "b"), stats=stats) == reranker_module.SKIP_FEW_CANDIDATES
+    assert policy.decide(choices=scored("a", "b", "c"), stats=stats) == reranker_module.LLM_RERANK
+    # a single chunk is never reranked
+    assert policy.decide(choices=scored("a"), stats=stats, top_n=1) == reranker_module.SKIP_FEW_CANDIDATES
+
+
+def long_scored(*names):
+    # ~1k token chunks, two of them fill the gpt-3.5 rerank budget
+    return [ScoredNode(node=Node(text=(name + " ") * 1200, metadata={}, node_id=name), score=0.9) for name in names]
+
+
+def test_candidates_over_the_budget_follow_the_llm_picks(monkeypatch):
+    completions = FakeCompletions([json.dumps([{"doc": 2, "relevance": 9}])])
+    monkeypatch.setattr(reranker_module.LiteLLM, "acompletion", completions, raising=False)
+    reranker = Reranker(top_n=5, cache=RerankCache())
+    query = Query("question", embedding=[1.0])
+
+    ranked = asyncio.run(reranker.llm_rerank(query=query, choices=long_scored("a", "b", "c", "d")))
+
+    assert completions.prompts[0].count("Doc ") == 2
+    # a was judged irrelevant, c and d weren't judged
+    assert [node.node_id for node in ranked] == ["b", "c", "d"]
+    # a cache hit ranks the same
+    assert [node.node_id for node in asyncio.run(reranker.llm_rerank(query=query, choices=long_scored("a", "b", "c", "d")))] == ["b", "c", "d"]
+
+
+def test_batch_query_packed_out_keeps_its_candidates(monkeypatch):
+    # the pool is a1, b1, c1, a2, only a1 and b1 fit
+    completions = FakeCompletions([json.dumps({"1": [{"doc": 1, "relevance": 9}], "2": [{"doc": 2, "relevance": 7}], "3": []})])
+    monkeypatch.setattr(reranker_module.LiteLLM, "acompletion", completions, raising=False)
+    reranker = Reranker(top_n=5)
+
+    first, second, third = asyncio.run(reranker.llm_rerank_batch(
+        queries=[Query("first", embedding=[1.0]), Query("second", embedding=[1.0]), Query("third", embedding=[1.0])],
+        choices=[long_scored("a1", "a2"), long_scored("b1"), long_scored("c1")]))
+
+    assert completions.prompts[0].count("Doc ") == 2
+    assert [node.node_id for node in first] == ["a1", "a2"]
+    assert [node.node_id for node in second] == ["b1"]
+    assert [node.node_id for node in third] == ["c1"]
+
+
+def test_rerank_many_splits_batches_by_token_budget(monkeypatch):
+    completions = FakeCompletions([json.dumps({"1": [{"doc": 2, "relevance": 9}, {"doc": 1, "relevance": 5}]})] * 2)
+    monkeypatch.setattr(reranker_module.LiteLLM, "acompletion", completions, raising=False)
+    reranker = Reranker(top_n=5, policy=RerankPolicy(min_candidates=1, dominant_score_gap=None))
+
+    first, second = asyncio.run(reranker.rerank_many(
+        queries=[Query("first", embedding=[1.0]), Query("second", embedding=[1.0])],
+        choices=[long_scored("a1", "a2"), long_scored("b1", "b2")]))
+
+    assert len(completions.prompts) == 2
+    assert [node.node_id for node in first] == ["a2", "a1"]
+    assert [node.node_id for node in second] == ["b2", "b1"]
+
+
+def test_failed_audit_is_counted(monkeypatch):
+    async def failing_completion(model, messages, **kwargs):
+        raise ConnectionResetError()
+
+    monkeypatch.setattr(reranker_module.LiteLLM, "acompletion", failing_completion, raising=False)
+    reranker = Reranker(top_n=5)
+
+    asyncio.run(reranker._audit(query=Query("question", embedding=[1.0]), choices=scored("a", "b")))
+
+    assert reranker.stats.audits == 0
+    assert reranker.stats.audit_failures == 1
@@ -0,0 +1,59 @@
+import asyncio
+import types
+from contextlib import asynccontextmanager
+
+import pytest
+
+from Database import BINARY_PRECISION, FULL_PRECISION, HALF_PRECISION
+from VectorIndex import HNSW, IVFFLAT, MAX_IDENTIFIER_BYTES, VectorIndexManager, parse_extension_version, postgres_identifier
+
+
+def manager():
+    return VectorIndexManager(types.SimpleNamespace(vector_store_table="data_v1"))
+
+
+def test_short_index_names_are_unchanged():
+    assert manager().index_name(HNSW) == "data_v1_embedding_hnsw_idx"
+    assert manager().index_name(IVFFLAT, HALF_PRECISION) == "data_v1_embedding_half_ivfflat_idx"
+
+
+def test_partition_index_names_fit_and_stay_distinct():
+    # a tenant and source partition, see the data_v1_partitioning migration
+    table = "data_v1_0123456789abcdef_google_drive"
+    names = [manager().index_name(method, precision, table)
+             for method in [HNSW, IVFFLAT] for precision in [FULL_PRECISION, HALF_PRECISION, BINARY_PRECISION]]
+
+    assert all(len(name.encode()) <= MAX_IDENTIFIER_BYTES for name in names)
+    assert len(set(names)) == len(names)
+    assert manager().index_name(IVFFLAT, BINARY_PRECISION, table) == manager().index_name(IVFFLAT, BINARY_PRECISION, table)
+
+
+def test_identifier_prefix_keeps_multibyte_characters_whole():
+    name = postgres_identifier("é" * 40)
+    assert len(name.encode()) <= MAX_IDENTIFIER_BYTES
+    assert name.startswith("é" * 27)
+
+
+def manager_with_pgvector(extversion):
+    class Connection():
+        async def fetchval(self, sql_query, *args):
+            return extversion
+
+    @asynccontextmanager
+    async def acquire():
+        yield Connection()
+
+    return VectorIndexManager(types.SimpleNamespace(vector_store_table="data_v1", acquire=acquire))
+
+
+def test_extension_versions_compare_numerically():
+    assert parse_extension_version("0.10.0") > parse_extension_version("0.7.0")
+    assert parse_extension_version("0.8.0-dev") == (0, 8, 0)
+
+
+def test_compact_precisions_need_pgvector_0_7():
+    with pytest.raises(Exception, match="pgvector 0.7.0"):
+        asyncio.run(manager_with_pgvector("0.6.2").create_index(method=HNSW, precision=HALF_PRECISION))
+    asyncio.run(manager_with_pgvector("0.7.0").check_precision_support(BINARY_PRECISION))
+    # full precision works on any version
+    asyncio.run(manager_with_pgvector("0.5.1").check_precision_support(FULL_PRECISION))
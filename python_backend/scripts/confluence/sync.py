@@ -6,11 +6,12 @@ import requests
 from atlassian import Confluence
 from llama_hub.confluence import ConfluenceReader
 from llama_index.readers.base import BasePydanticReader
-from llama_index.schema import MetadataMode
 from prisma import Prisma
 from requests.auth import HTTPBasicAuth
 
 from util.ServiceContext import embed_model, node_parser, vector_store
+from util.chunks import delete_document_chunks, ensure_chunk_partition, notify_chunks_changed
+from util.embeddings import embed_nodes
 from util.helper import get_secret
 from util.logs import end_log, fetch_last_sync_log, start_log, Code
 
@@ -25,10 +26,15 @@ Metadata:
 
     permissions_user: list
     permissions_group: list
+
+    user_id: str
+    source: str
 '''
 
-excluded_embed_metadata_keys = ['id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group']
-excluded_llm_metadata_keys = ['id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group']
+# partition key of the chunks next to user_id, see util/chunks.py
+SOURCE = 'confluence'
+excluded_embed_metadata_keys = ['id', 'url', 'last_modified', 'last_author_name', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'user_id', 'source']
+excluded_llm_metadata_keys = ['id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'user_id', 'source']
 
 class ConfluencePageReader(BasePydanticReader):
     '''
@@ -127,28 +133,21 @@ class ConfluencePageReader(BasePydanticReader):
             d.metadata['permissions_user'] = read_perms['restrictions']['user']['results']
             d.metadata['permissions_group'] = read_perms['restrictions']['group']['results']
             d.metadata['id'] = d.metadata['page_id']
+            d.metadata['user_id'] = self.user_id
+            d.metadata['source'] = SOURCE
             del d.metadata['status']
             del d.metadata['page_id']
             d.excluded_embed_metadata_keys = excluded_embed_metadata_keys
             d.excluded_llm_metadata_keys = excluded_llm_metadata_keys
 
-        db = Prisma()
-        if not db.is_connected():
-            await db.connect()
-        ids = [d.id_ for d in docs]
-        ids_formatted = ', '.join(f"'{id}'" for id in ids)
-        sql_query = f"""
-            DELETE FROM "data_v1"
-            WHERE metadata_ ->> 'doc_id' IN ({ids_formatted})
-        """
-        await db.execute_raw(sql_query)
+        await delete_document_chunks([d.id_ for d in docs], self.user_id, SOURCE)
 
         nodes = node_parser.get_nodes_from_documents(docs)
-        for n in nodes:
-            n.embedding = embed_model.get_text_embedding(
-                n.get_content(metadata_mode=MetadataMode.EMBED))
+        await embed_nodes(nodes, embed_model)
 
+        await ensure_chunk_partition(self.user_id, SOURCE)
         vector_store.add(nodes)
+        await notify_chunks_changed(self.user_id, [d.id_ for d in docs])
 
     async def init_sync(self):
         '''
@@ -11,10 +11,12 @@ from googleapiclient.http import MediaIoBaseDownload
 import textract
 
 from llama_index.readers.base import BasePydanticReader
-from llama_index.schema import Document, MetadataMode
+from llama_index.schema import Document
 from prisma import Prisma, Json
 
 from util.ServiceContext import embed_model, node_parser, vector_store
+from util.chunks import delete_document_chunks, ensure_chunk_partition, notify_chunks_changed
+from util.embeddings import embed_nodes
 from util.logs import end_log, start_log, Code
 
 TEMP_DIR = "./temp"
@@ -32,10 +34,15 @@ Metadata:
     permissions_user: list
     permissions_group: list
     permissions_misc: str
+
+    user_id: str
+    source: str
 '''
 
-excluded_embed_metadata_keys = ['id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'permissions_misc']
-excluded_llm_metadata_keys = ['id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'permissions_misc']
+# partition key of the chunks next to user_id, see util/chunks.py
+SOURCE = 'google_drive'
+excluded_embed_metadata_keys = ['id', 'url', 'last_modified', 'last_author_name', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'permissions_misc', 'user_id', 'source']
+excluded_llm_metadata_keys = ['id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'permissions_misc', 'user_id', 'source']
 
 # the only mimeTypes we will process
 WHITELISTED_MIMETYPES = [
@@ -217,26 +224,22 @@ class GDriveReader(BasePydanticReader):
             'permissions_user': permissions_user,
             'permissions_group': permissions_group,
             'permissions_misc': permissions_misc,
+
+            'user_id': self.user_id,
+            'source': SOURCE,
         }
 
         doc.excluded_embed_metadata_keys = excluded_embed_metadata_keys
         doc.excluded_llm_metadata_keys = excluded_llm_metadata_keys
 
-        db = Prisma()
-        if not db.is_connected():
-            await db.connect()
-        sql_query = f"""
-            DELETE FROM "data_v1"
-            WHERE metadata_ ->> 'doc_id' = '{doc.doc_id}' -- #TODO:  check
-        """
-        await db.execute_raw(sql_query)
+        await delete_document_chunks([doc.doc_id], self.user_id, SOURCE)
 
         nodes = node_parser.get_nodes_from_documents([doc])
-        for n in nodes:
-            n.embedding = embed_model.get_text_embedding(
-                n.get_content(metadata_mode=MetadataMode.EMBED))
+        await embed_nodes(nodes, embed_model)
 
+        await ensure_chunk_partition(self.user_id, SOURCE)
         vector_store.add(nodes)
+        await notify_chunks_changed(self.user_id, [doc.doc_id])
 
         # delete the temp file
         import os
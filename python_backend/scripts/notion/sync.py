@@ -6,10 +6,12 @@ from typing import Any, Dict, List, Optional
 from ratelimiter import RateLimiter
 
 from llama_index.readers.base import BasePydanticReader
-from llama_index.schema import Document, MetadataMode
+from llama_index.schema import Document
 from prisma import Prisma
 
 from util.ServiceContext import embed_model, node_parser, vector_store
+from util.chunks import delete_document_chunks, ensure_chunk_partition, notify_chunks_changed
+from util.embeddings import embed_nodes
 from util.helper import get_secret
 from util.logs import end_log, fetch_last_sync_log, start_log, Code
 
@@ -22,12 +24,17 @@ Metadata:
     *last_modified: datestr
     *last_author_name: str
     last_author_picture_url: str
+
+    user_id: str
+    source: str
 '''
 
+# partition key of the chunks next to user_id, see util/chunks.py
+SOURCE = 'notion'
 excluded_embed_metadata_keys = [
-    'id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group']
+    'id', 'url', 'last_modified', 'last_author_name', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'user_id', 'source']
 excluded_llm_metadata_keys = [
-    'id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group']
+    'id', 'url', 'last_author_picture_url', 'permissions_user', 'permissions_group', 'user_id', 'source']
 
 INTEGRATION_TOKEN_NAME = "NOTION_INTEGRATION_TOKEN"
 BLOCK_CHILD_URL_TMPL = "https://api.notion.com/v1/blocks/{block_id}/children"
@@ -254,23 +261,18 @@ class NotionPageReader(BasePydanticReader):
                     doc.metadata['last_modified'] = page["last_edited_time"]
                     doc.metadata['last_author_name'] = name
                     doc.metadata['last_author_picture_url'] = avatar_url
+                    doc.metadata['user_id'] = self.user_id
+                    doc.metadata['source'] = SOURCE
 
-                    db = Prisma()
-                    if not db.is_connected():
-                        await db.connect()
-                    sql_query = f"""
-                        DELETE FROM "data_v1"
-                        WHERE metadata_ ->> 'doc_id' = '{doc.id_}'
-                    """
-                    await db.execute_raw(sql_query)
+                    await delete_document_chunks([doc.id_], self.user_id, SOURCE)
 
                     nodes = node_parser.get_nodes_from_documents([doc])
                     page_count += 1
-                    for n in nodes:
-                        n.embedding = embed_model.get_text_embedding(
-                            n.get_content(metadata_mode=MetadataMode.EMBED))
+                    await embed_nodes(nodes, embed_model)
 
+                    await ensure_chunk_partition(self.user_id, SOURCE)
                     vector_store.add(nodes)
+                    await notify_chunks_changed(self.user_id, [doc.id_])
 
         except Exception as e:
             await end_log(self.user_id, 'notion', Code.FAILED, str(e))
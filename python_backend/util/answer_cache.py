@@ -0,0 +1,18 @@
+from typing import List
+
+from prisma import Prisma
+
+
+async def invalidate_answers(doc_ids: List[str]) -> int:
+    '''
+    Drops every cached answer citing one of the documents, returns the number of dropped answers.
+    The answers are cached by rag_utils/AnswerCache.py, see the answer_cache migration
+    '''
+    if len(doc_ids) == 0:
+        return 0
+
+    db = Prisma()
+    if not db.is_connected():
+        await db.connect()
+
+    return await db.execute_raw("DELETE FROM answer_cache WHERE doc_ids && $1::text[]", doc_ids)
@@ -0,0 +1,80 @@
+import json
+from typing import List, Optional
+
+from prisma import Prisma
+
+from util.answer_cache import invalidate_answers
+
+VECTOR_STORE_TABLE = "data_v1"
+# rag_utils servers listen on this channel to refresh their rerank caches and memory mapped snapshots
+# (see rag_utils/ConversationEngine.py listen)
+CHUNKS_CHANGED_CHANNEL = "chunks_changed"
+# NOTIFY payloads are capped at 8000 bytes, so large syncs are reported in batches of documents
+NOTIFY_DOC_BATCH_SIZE = 50
+
+
+async def ensure_chunk_partition(user_id: str, source: str) -> str:
+    '''
+    Creates the vector store partitions of a tenant and source if they don't exist yet, returns the partition their chunks go to.
+    Chunks are routed by the "user_id" and "source" metadata keys, see the data_v1_partitioning migration
+    '''
+    db = Prisma()
+    if not db.is_connected():
+        await db.connect()
+
+    rows = await db.query_raw("SELECT ensure_chunk_partition($1, $2, $3) AS partition",
+                              VECTOR_STORE_TABLE, user_id, source)
+    return rows[0]['partition']
+
+
+async def delete_document_chunks(doc_ids: List[str], user_id: Optional[str] = None, source: Optional[str] = None) -> int:
+    '''
+    Deletes every chunk of the given documents from the vector store and the cached answers citing them,
+    returns the number of deleted chunks.
+    With a user_id (and source) only that partition and the default one are scanned: chunks written before the
+    partitioning migration have no user_id and are deleted too, so a re-sync doesn't leave them behind as duplicates
+    '''
+    if len(doc_ids) == 0:
+        return 0
+
+    db = Prisma()
+    if not db.is_connected():
+        await db.connect()
+
+    # plain equality on the ->> expressions so the metadata_ doc_id expression index is used and partitions are pruned
+    params = list(doc_ids)
+    placeholders = ', '.join(f'${i + 1}' for i in range(len(doc_ids)))
+    sql_query = f"""
+        DELETE FROM "{VECTOR_STORE_TABLE}"
+        WHERE metadata_ ->> 'doc_id' IN ({placeholders})
+    """
+    if user_id is not None:
+        params.append(user_id)
+        sql_query += f" AND (metadata_ ->> 'user_id' = ${len(params)} OR metadata_ ->> 'user_id' IS NULL)"
+    if source is not None:
+        params.append(source)
+        sql_query += f" AND (metadata_ ->> 'source' = ${len(params)} OR metadata_ ->> 'user_id' IS NULL)"
+    deleted_count = await db.execute_raw(sql_query, *params)
+
+    # answers citing the old chunks are stale
+    await invalidate_answers(doc_ids)
+    return deleted_count
+
+
+async def notify_chunks_changed(user_id: str, doc_ids: List[str]):
+    '''
+    Tells listening servers that the chunks of these documents were rewritten
+    '''
+    if len(doc_ids) == 0:
+        return
+
+    db = Prisma()
+    if not db.is_connected():
+        await db.connect()
+
+    for i in range(0, len(doc_ids), NOTIFY_DOC_BATCH_SIZE):
+        payload = json.dumps({
+            'user_id': user_id,
+            'doc_ids': doc_ids[i:i + NOTIFY_DOC_BATCH_SIZE],
+        })
+        await db.execute_raw("SELECT pg_notify($1, $2)", CHUNKS_CHANGED_CHANNEL, payload)
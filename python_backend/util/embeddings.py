@@ -0,0 +1,63 @@
+import hashlib
+import json
+from typing import Dict, List
+
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.schema import BaseNode, MetadataMode
+from prisma import Prisma
+
+# the same table as rag_utils/EmbeddingCache.py, but the two never share entries: chunks here are keyed by the llama_index
+# model name and their exact embed content, queries there by the LiteLLM model name and their normalized text
+EMBEDDING_CACHE_TABLE = "embedding_cache"
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def vector_literal(embedding: List[float]) -> str:
+    return "[" + ",".join(str(value) for value in embedding) + "]"
+
+
+async def embed_nodes(nodes: List[BaseNode], embed_model: BaseEmbedding) -> int:
+    '''
+    Sets the embedding of every node, reusing the stored embedding of any chunk whose embed content was embedded before
+    (by an earlier sync of the document or anywhere else). Only new content is sent to the API and then stored.
+    Returns the number of chunks that had to be embedded
+    '''
+    if len(nodes) == 0:
+        return 0
+
+    contents = [node.get_content(metadata_mode=MetadataMode.EMBED)
+                for node in nodes]
+    hashes = [content_hash(content) for content in contents]
+
+    db = Prisma()
+    if not db.is_connected():
+        await db.connect()
+
+    rows = await db.query_raw(f"""
+        SELECT content_hash, embedding::text AS embedding FROM {EMBEDDING_CACHE_TABLE}
+        WHERE model = $1 AND content_hash = ANY($2::text[])
+    """, embed_model.model_name, list(set(hashes)))
+    embeddings: Dict[str, List[float]] = {
+        row['content_hash']: json.loads(row['embedding']) for row in rows}
+
+    # identical chunks (boilerplate, repeated headers) are embedded once
+    new_contents = {}
+    for digest, content in zip(hashes, contents):
+        if digest not in embeddings:
+            new_contents[digest] = content
+
+    if len(new_contents) > 0:
+        new_embeddings = await embed_model.aget_text_embedding_batch(list(new_contents.values()))
+        embeddings.update(zip(new_contents.keys(), new_embeddings))
+        await db.execute_raw(f"""
+            INSERT INTO {EMBEDDING_CACHE_TABLE} (model, content_hash, embedding)
+            SELECT $1, e.content_hash, e.embedding::vector FROM unnest($2::text[], $3::text[]) AS e(content_hash, embedding)
+            ON CONFLICT DO NOTHING
+        """, embed_model.model_name, list(new_contents.keys()), [vector_literal(embedding) for embedding in new_embeddings])
+
+    for node, digest in zip(nodes, hashes):
+        node.embedding = embeddings[digest]
+    return len(new_contents)